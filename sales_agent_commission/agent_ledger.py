@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from frappe.utils import add_days, add_months, cint, flt, get_last_day, getdate, now_datetime, today
+
+def get_current_balance(agent):
+    """Get the current ledger balance of an agent"""
+    balance = frappe.db.get_value("Agent Ledger Balance", agent, "balance")
+    if balance is None:
+        return get_ledger_balances([agent]).get(agent, 0)
+
+    return flt(balance)
+
+def get_ledger_balances(agents):
+    """Sum the active ledger entries of agents"""
+    return {
+        agent: flt(balance)
+        for agent, balance in frappe.db.sql("""
+            SELECT agent, SUM(debit) - SUM(credit)
+            FROM `tabAgent Ledger Entry`
+            WHERE agent IN %(agents)s
+            AND docstatus < 2
+            GROUP BY agent
+        """, {"agents": tuple(agents)})
+    }
+
+def lock_agent_balances(agents):
+    """Lock the balance rows of agents for the rest of the transaction and
+    return their balances.
+
+    Rows are locked in name order within a call, so a transaction posting
+    for several agents must lock all of them with one call before posting
+    to any; concurrent postings then serialize without deadlocks. Missing
+    rows are created from the ledger.
+
+    Existing rows are locked before anything else is read, so ledger reads
+    that follow also see the postings committed while waiting for the lock."""
+    agents = sorted(set(filter(None, agents)))
+    if not agents:
+        return {}
+
+    balances = select_agent_balances_for_update(agents)
+    missing = [agent for agent in agents if agent not in balances]
+    if missing:
+        create_agent_balances(missing)
+        balances.update(select_agent_balances_for_update(missing))
+
+    return balances
+
+def select_agent_balances_for_update(agents):
+    return {
+        agent: flt(balance)
+        for agent, balance in frappe.db.sql("""
+            SELECT name, balance
+            FROM `tabAgent Ledger Balance`
+            WHERE name IN %(agents)s
+            ORDER BY name
+            FOR UPDATE
+        """, {"agents": tuple(agents)})
+    }
+
+def create_agent_balances(agents):
+    """Create balance rows seeded from the ledger. Rows created concurrently
+    by another transaction are left alone."""
+    balances = get_ledger_balances(agents)
+    agent_names = dict(frappe.get_all("Agent Master",
+        filters={"name": ["in", list(agents)]}, fields=["name", "agent_name"], as_list=1))
+    now = now_datetime()
+    user = frappe.session.user
+
+    for agent in agents:
+        frappe.db.sql("""
+            INSERT IGNORE INTO `tabAgent Ledger Balance`
+                (name, agent, agent_name, balance, creation, modified, owner, modified_by, docstatus, idx)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 0, 0)
+        """, (agent, agent, agent_names.get(agent), balances.get(agent, 0), now, now, user, user))
+
+def update_agent_balances(balances):
+    """Write new balances of agents locked with `lock_agent_balances`"""
+    now = now_datetime()
+    for agent, balance in balances.items():
+        frappe.db.sql("""
+            UPDATE `tabAgent Ledger Balance`
+            SET balance = %s, modified = %s
+            WHERE name = %s
+        """, (balance, now, agent))
+
+def post_to_agent_balance(agent, amount, posting_date=None):
+    """Add an amount to the balance of an agent and return the new balance.
+
+    The balance row stays locked until the transaction ends, so post before
+    inserting the ledger entry carrying the returned balance. Checkpoints on
+    or after a backdated posting date are shifted by the amount."""
+    balance = lock_agent_balances([agent])[agent] + flt(amount)
+    update_agent_balances({agent: balance})
+
+    if posting_date:
+        shift_checkpoints({(agent, getdate(posting_date)): flt(amount)})
+
+    return balance
+
+def cancel_ledger_entries(reference_type, reference_name):
+    """Cancel the ledger entries of a document and take them out of the agent balances"""
+    amounts = frappe.db.sql("""
+        SELECT agent, posting_date, SUM(debit) - SUM(credit)
+        FROM `tabAgent Ledger Entry`
+        WHERE reference_type = %s
+        AND reference_name = %s
+        AND docstatus < 2
+        GROUP BY agent, posting_date
+    """, (reference_type, reference_name))
+
+    balances = lock_agent_balances([agent for agent, posting_date, amount in amounts])
+    checkpoint_amounts = {}
+    for agent, posting_date, amount in amounts:
+        balances[agent] -= flt(amount)
+        checkpoint_amounts[(agent, getdate(posting_date))] = -flt(amount)
+
+    update_agent_balances(balances)
+    shift_checkpoints(checkpoint_amounts)
+
+    frappe.db.sql("""
+        UPDATE `tabAgent Ledger Entry`
+        SET docstatus = 2
+        WHERE reference_type = %s
+        AND reference_name = %s
+        AND docstatus < 2
+    """, (reference_type, reference_name))
+
+# Checkpoints
+
+def shift_checkpoints(amounts):
+    """Carry postings into the checkpoints they change, given
+    {(agent, posting_date): amount}. Checkpoints are kept, so backdated
+    postings and cancellations never send balance lookups back to long scans."""
+    for (agent, posting_date), amount in amounts.items():
+        if not flt(amount):
+            continue
+
+        frappe.db.sql("""
+            UPDATE `tabAgent Ledger Checkpoint`
+            SET balance = balance + %s
+            WHERE agent = %s
+            AND checkpoint_date >= %s
+        """, (flt(amount), agent, posting_date))
+
+def get_nearest_checkpoint(agent, as_of):
+    """Get the latest checkpoint of an agent on or before a date"""
+    checkpoint = frappe.db.sql("""
+        SELECT checkpoint_date, balance
+        FROM `tabAgent Ledger Checkpoint`
+        WHERE agent = %s
+        AND checkpoint_date <= %s
+        ORDER BY checkpoint_date DESC
+        LIMIT 1
+    """, (agent, as_of), as_dict=1)
+
+    return checkpoint[0] if checkpoint else None
+
+def get_balance_as_of(agent, as_of):
+    """Ledger balance of an agent including all entries posted on or before a
+    date, summing only the entries after the nearest checkpoint"""
+    as_of = getdate(as_of)
+    checkpoint = get_nearest_checkpoint(agent, as_of)
+
+    conditions = ""
+    if checkpoint:
+        if checkpoint.checkpoint_date == as_of:
+            return flt(checkpoint.balance)
+        conditions = "AND posting_date > %(checkpoint_date)s"
+
+    movement = frappe.db.sql("""
+        SELECT SUM(debit) - SUM(credit)
+        FROM `tabAgent Ledger Entry`
+        WHERE agent = %(agent)s
+        AND docstatus < 2
+        AND posting_date <= %(as_of)s
+        {conditions}
+    """.format(conditions=conditions), {
+        "agent": agent,
+        "as_of": as_of,
+        "checkpoint_date": checkpoint.checkpoint_date if checkpoint else None
+    })[0][0]
+
+    return flt(checkpoint.balance if checkpoint else 0) + flt(movement)
+
+def save_checkpoint(agent, checkpoint_date, balance):
+    name = frappe.db.get_value("Agent Ledger Checkpoint", {"agent": agent, "checkpoint_date": checkpoint_date})
+    if name:
+        frappe.db.set_value("Agent Ledger Checkpoint", name, "balance", balance)
+        return
+
+    frappe.get_doc({
+        "doctype": "Agent Ledger Checkpoint",
+        "agent": agent,
+        "checkpoint_date": checkpoint_date,
+        "balance": balance
+    }).insert(ignore_permissions=True)
+
+def create_ledger_checkpoints(checkpoint_date=None):
+    """Monthly task to checkpoint every agent's balance at the previous month end"""
+    checkpoint_date = getdate(checkpoint_date) if checkpoint_date else get_last_day(add_months(today(), -1))
+
+    agents = frappe.get_all("Agent Ledger Entry",
+        filters={"posting_date": ["<=", checkpoint_date], "docstatus": ["<", 2]},
+        pluck="agent",
+        distinct=True)
+
+    for agent in agents:
+        # Locked until the commit, so no backdated posting lands between the
+        # sum and the save. Each checkpoint builds on the previous one, so
+        # only a month is summed.
+        lock_agent_balances([agent])
+        save_checkpoint(agent, checkpoint_date, get_balance_as_of(agent, checkpoint_date))
+        frappe.db.commit()
+
+@frappe.whitelist()
+def get_agent_balance(agent, as_of=None):
+    """Get the ledger balance of an agent as of a date, or the current balance"""
+    frappe.has_permission("Agent Ledger Entry", "read", throw=True)
+
+    if not as_of:
+        return get_current_balance(agent)
+
+    return get_balance_as_of(agent, as_of)
+
+@frappe.whitelist()
+def get_agent_statement(agent, from_date, to_date=None):
+    """Get the ledger statement of an agent with opening, running and closing balances"""
+    frappe.has_permission("Agent Ledger Entry", "read", throw=True)
+
+    from_date = getdate(from_date)
+    to_date = getdate(to_date or today())
+    if from_date > to_date:
+        frappe.throw(_("From Date cannot be after To Date"))
+
+    opening_balance = get_balance_as_of(agent, add_days(from_date, -1))
+
+    entries = frappe.db.sql("""
+        SELECT name, posting_date, entry_type, reference_type, reference_name,
+            sales_invoice, debit, credit, remarks
+        FROM `tabAgent Ledger Entry`
+        WHERE agent = %s
+        AND docstatus < 2
+        AND posting_date BETWEEN %s AND %s
+        ORDER BY posting_date, creation, name
+    """, (agent, from_date, to_date), as_dict=1)
+
+    balance = opening_balance
+    for entry in entries:
+        balance += flt(entry.debit) - flt(entry.credit)
+        entry.balance = balance
+
+    return {
+        "agent": agent,
+        "from_date": from_date,
+        "to_date": to_date,
+        "opening_balance": opening_balance,
+        "entries": entries,
+        "closing_balance": balance
+    }
+
+# Repair
+
+REPAIR_STATUS_KEY = "agent_ledger_repair"
+REPAIR_BATCH_SIZE = 1000
+
+def repair_agent_ledger(agent, batch_size=REPAIR_BATCH_SIZE):
+    """Recompute the stored running balances of an agent's ledger.
+
+    Active entries are read in (posting_date, creation, name) order in keyset
+    paginated batches, and the drifted rows of each batch are rewritten with
+    batched UPDATEs before the next one is read, so memory stays bounded by
+    the batch size. The agent's checkpoints are rebuilt from the same pass.
+    The agent's balance row stays locked, so no posting can interleave.
+    Returns the number of drifted rows."""
+    batch_size = cint(batch_size) or REPAIR_BATCH_SIZE
+    precision = frappe.get_precision("Agent Ledger Entry", "balance") or 2
+
+    lock_agent_balances([agent])
+
+    checkpoints = frappe.db.sql("""
+        SELECT name, checkpoint_date, balance
+        FROM `tabAgent Ledger Checkpoint`
+        WHERE agent = %s
+        ORDER BY checkpoint_date
+    """, agent, as_dict=1)
+    checkpoint_balances = {}
+    next_checkpoint = 0
+
+    drifted = 0
+    balance = 0
+    last = None
+    while True:
+        keyset = ""
+        if last:
+            keyset = """AND (posting_date > %(last_posting_date)s
+                OR (posting_date = %(last_posting_date)s AND (creation > %(last_creation)s
+                    OR (creation = %(last_creation)s AND name > %(last_name)s))))"""
+
+        entries = frappe.db.sql("""
+            SELECT name, posting_date, creation, debit, credit, balance
+            FROM `tabAgent Ledger Entry`
+            WHERE agent = %(agent)s
+            AND docstatus < 2
+            {keyset}
+            ORDER BY posting_date, creation, name
+            LIMIT %(batch_size)s
+        """.format(keyset=keyset), {
+            "agent": agent,
+            "last_posting_date": last.posting_date if last else None,
+            "last_creation": last.creation if last else None,
+            "last_name": last.name if last else None,
+            "batch_size": batch_size
+        }, as_dict=1)
+
+        if not entries:
+            break
+
+        corrections = {}
+        for entry in entries:
+            # Checkpoints dated before this entry hold the balance so far
+            while (next_checkpoint < len(checkpoints)
+                and checkpoints[next_checkpoint].checkpoint_date < entry.posting_date):
+                checkpoint_balances[checkpoints[next_checkpoint].name] = balance
+                next_checkpoint += 1
+
+            balance = flt(balance + flt(entry.debit) - flt(entry.credit), precision)
+            if flt(entry.balance, precision) != balance:
+                corrections[entry.name] = {"balance": balance}
+
+        if corrections:
+            frappe.db.bulk_update("Agent Ledger Entry", corrections, chunk_size=batch_size, update_modified=False)
+            drifted += len(corrections)
+
+        last = entries[-1]
+
+    for checkpoint in checkpoints[next_checkpoint:]:
+        checkpoint_balances[checkpoint.name] = balance
+
+    checkpoint_corrections = {
+        checkpoint.name: {"balance": checkpoint_balances[checkpoint.name]}
+        for checkpoint in checkpoints
+        if flt(checkpoint.balance, precision) != checkpoint_balances[checkpoint.name]
+    }
+    if checkpoint_corrections:
+        frappe.db.bulk_update("Agent Ledger Checkpoint", checkpoint_corrections, update_modified=False)
+
+    update_agent_balances({agent: balance})
+
+    return drifted
+
+def run_ledger_repair(agent, batch_size=REPAIR_BATCH_SIZE):
+    """Background job repairing the ledger of one agent and recording its drift"""
+    try:
+        drifted = repair_agent_ledger(agent, batch_size)
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(title=f"Agent ledger repair failed for {agent}")
+        drifted = None
+
+    frappe.cache().hset(REPAIR_STATUS_KEY, agent, drifted)
+    frappe.publish_realtime("agent_ledger_repair_progress", {"agent": agent, "drifted": drifted})
+
+    return drifted
+
+def get_ledger_agents():
+    return frappe.get_all("Agent Ledger Entry", pluck="agent", distinct=True, order_by="agent")
+
+@frappe.whitelist()
+def enqueue_ledger_repair(agents=None, batch_size=REPAIR_BATCH_SIZE):
+    """Repair agent ledgers in parallel background jobs, one per agent.
+    Repairs every agent with ledger entries unless agents are given."""
+    frappe.only_for(("System Manager", "Accounts Manager"))
+
+    return enqueue_ledger_repair_jobs(frappe.parse_json(agents) if agents else get_ledger_agents(), batch_size)
+
+def enqueue_ledger_repair_jobs(agents, batch_size=REPAIR_BATCH_SIZE):
+    frappe.cache().delete_value(REPAIR_STATUS_KEY)
+
+    for agent in agents:
+        frappe.enqueue(
+            run_ledger_repair,
+            queue="long",
+            job_id=f"agent_ledger_repair::{agent}",
+            deduplicate=True,
+            agent=agent,
+            batch_size=batch_size
+        )
+
+    return len(agents)
+
+@frappe.whitelist()
+def get_ledger_repair_status():
+    """Get the drifted rows per agent of the last repair run"""
+    frappe.only_for(("System Manager", "Accounts Manager"))
+
+    results = {
+        frappe.safe_decode(agent): drifted
+        for agent, drifted in (frappe.cache().hgetall(REPAIR_STATUS_KEY) or {}).items()
+    }
+
+    return {
+        "agents": len(results),
+        "failed": [agent for agent, drifted in results.items() if drifted is None],
+        "drifted": sum(drifted for drifted in results.values() if drifted),
+        "by_agent": results
+    }
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+from bisect import bisect_right
+
+import frappe
+
+ASSIGNMENT_MAP_CACHE_KEY = "agent_assignment_map"
+
+def build_assignment_map():
+    """Build customer -> agents and territory -> agents maps from all active,
+    submitted Agent Masters in a single query"""
+    assignments = frappe.db.sql("""
+        SELECT am.name AS agent, 'customer' AS assignment_type, aca.customer AS assigned_to
+        FROM `tabAgent Master` am
+        INNER JOIN `tabAgent Customer Assignment` aca ON aca.parent = am.name
+        WHERE am.status = 'Active'
+        AND am.docstatus = 1
+        UNION ALL
+        SELECT am.name AS agent, 'territory' AS assignment_type, ata.territory AS assigned_to
+        FROM `tabAgent Master` am
+        INNER JOIN `tabAgent Territory Assignment` ata ON ata.parent = am.name
+        WHERE am.status = 'Active'
+        AND am.docstatus = 1
+    """, as_dict=1)
+
+    assignment_map = {"customer": {}, "territory": {}, "agents": {}}
+    for row in assignments:
+        add_assignment(assignment_map, row.agent, row.assignment_type, row.assigned_to)
+
+    assignment_map["territory_bounds"] = get_territory_bounds()
+    build_territory_index(assignment_map)
+
+    return assignment_map
+
+def get_territory_bounds(territories=None):
+    """Get the nested set (lft, rgt) bounds of territories"""
+    filters = {"name": ["in", list(territories)]} if territories else {}
+    return {
+        d.name: (d.lft, d.rgt)
+        for d in frappe.get_all("Territory", filters=filters, fields=["name", "lft", "rgt"])
+    }
+
+def build_territory_index(assignment_map):
+    """Build an interval index over the assigned territories.
+
+    Intervals are sorted by lft and each one keeps a pointer to its nearest
+    enclosing assigned interval, so all assigned territories covering a
+    territory are found with one bisect followed by a walk up the chain."""
+    bounds = assignment_map["territory_bounds"]
+    intervals = sorted(
+        (bounds[territory][0], bounds[territory][1], territory)
+        for territory in assignment_map["territory"]
+        if territory in bounds
+    )
+
+    parents = []
+    stack = []
+    for idx, (lft, rgt, territory) in enumerate(intervals):
+        while stack and intervals[stack[-1]][1] < lft:
+            stack.pop()
+        parents.append(stack[-1] if stack else -1)
+        stack.append(idx)
+
+    assignment_map["territory_index"] = {
+        "lefts": [d[0] for d in intervals],
+        "intervals": intervals,
+        "parents": parents
+    }
+
+def get_covering_territories(assignment_map, territory):
+    """Get assigned territories covering a territory, nearest first"""
+    if not territory:
+        return []
+
+    bounds = assignment_map["territory_bounds"].get(territory)
+    if not bounds:
+        # Territory outside the tree, fall back to an exact match
+        return [territory] if territory in assignment_map["territory"] else []
+
+    lft, rgt = bounds
+    index = assignment_map["territory_index"]
+    intervals = index["intervals"]
+    parents = index["parents"]
+
+    covering = []
+    idx = bisect_right(index["lefts"], lft) - 1
+    while idx >= 0:
+        if intervals[idx][1] >= rgt:
+            covering.append(intervals[idx][2])
+        idx = parents[idx]
+
+    return covering
+
+def add_assignment(assignment_map, agent, assignment_type, assigned_to):
+    """Add a single customer or territory assignment of an agent to the map"""
+    if not assigned_to:
+        return
+
+    agents = assignment_map[assignment_type].setdefault(assigned_to, [])
+    if agent not in agents:
+        agents.append(agent)
+
+    assigned = assignment_map["agents"].setdefault(agent, {"customer": [], "territory": []})
+    if assigned_to not in assigned[assignment_type]:
+        assigned[assignment_type].append(assigned_to)
+
+def remove_agent(assignment_map, agent):
+    """Remove every assignment of an agent from the map"""
+    assigned = assignment_map["agents"].pop(agent, None)
+    if not assigned:
+        return
+
+    for assignment_type, values in assigned.items():
+        for assigned_to in values:
+            agents = assignment_map[assignment_type].get(assigned_to)
+            if not agents:
+                continue
+            if agent in agents:
+                agents.remove(agent)
+            if not agents:
+                del assignment_map[assignment_type][assigned_to]
+
+def get_assignment_map():
+    """Get the cached assignment map, building it on first use"""
+    return frappe.cache().get_value(ASSIGNMENT_MAP_CACHE_KEY, build_assignment_map)
+
+def refresh_agent_assignments(agent_doc):
+    """Incrementally refresh the assignments of one Agent Master in the cached map"""
+    assignment_map = frappe.cache().get_value(ASSIGNMENT_MAP_CACHE_KEY)
+    if assignment_map is None:
+        # Nothing cached yet, the next lookup builds the complete map
+        return
+
+    remove_agent(assignment_map, agent_doc.name)
+
+    if agent_doc.docstatus == 1 and agent_doc.status == "Active":
+        for assignment in agent_doc.customer_assignments:
+            add_assignment(assignment_map, agent_doc.name, "customer", assignment.customer)
+        for assignment in agent_doc.territories:
+            add_assignment(assignment_map, agent_doc.name, "territory", assignment.territory)
+
+    missing = [d for d in assignment_map["territory"] if d not in assignment_map["territory_bounds"]]
+    if missing:
+        assignment_map["territory_bounds"].update(get_territory_bounds(missing))
+
+    build_territory_index(assignment_map)
+    frappe.cache().set_value(ASSIGNMENT_MAP_CACHE_KEY, assignment_map)
+
+def remove_agent_assignments(agent):
+    """Drop an agent from the cached map, e.g. when it is deactivated"""
+    assignment_map = frappe.cache().get_value(ASSIGNMENT_MAP_CACHE_KEY)
+    if assignment_map is None:
+        return
+
+    remove_agent(assignment_map, agent)
+    build_territory_index(assignment_map)
+    frappe.cache().set_value(ASSIGNMENT_MAP_CACHE_KEY, assignment_map)
+
+def clear_assignment_map(doc=None, method=None):
+    """Invalidate the cached assignment map.
+
+    Also hooked to Territory changes, since moving or adding a territory
+    shifts the nested set bounds of the tree."""
+    frappe.cache().delete_value(ASSIGNMENT_MAP_CACHE_KEY)
+
+def resolve_agents(assignment_map, customer=None, territory=None):
+    """Resolve the agents applicable for a customer and territory.
+
+    Agents assigned to a parent territory apply to all its descendants."""
+    agents = []
+
+    for covering in get_covering_territories(assignment_map, territory):
+        agents.extend(assignment_map["territory"][covering])
+
+    if customer:
+        agents.extend(assignment_map["customer"].get(customer, []))
+
+    # Remove duplicates while keeping the order stable
+    return list(dict.fromkeys(agents))
+
+def get_applicable_agents(invoice):
+    """Get agents applicable for the invoice based on territory/customer"""
+    return resolve_agents(get_assignment_map(), invoice.get("customer"), invoice.get("territory"))
+
+def get_invoice_territories(invoice):
+    """Get assigned territories covering the invoice territory, nearest first"""
+    return get_covering_territories(get_assignment_map(), invoice.get("territory"))
+
+def get_applicable_agents_bulk(invoices):
+    """Get applicable agents for many invoices at once.
+
+    Accepts documents or dicts with name, customer and territory and returns
+    a dict of invoice name -> list of agents."""
+    assignment_map = get_assignment_map()
+
+    return {
+        invoice.get("name"): resolve_agents(assignment_map, invoice.get("customer"), invoice.get("territory"))
+        for invoice in invoices
+    }
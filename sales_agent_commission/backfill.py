@@ -0,0 +1,276 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""Historical commission backfill.
+
+Streams submitted Sales Invoices in a date range in keyset paginated chunks
+ordered by (posting_date, name), calculates Agent Commission Entries for a
+chunk in a process pool and writes the chunk with multi-row INSERTs in one
+transaction. Progress is checkpointed after every chunk so an interrupted
+run resumes where it stopped.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import frappe
+from frappe import _
+from frappe.utils import cint, getdate
+
+from sales_agent_commission.agent_resolver import (
+	get_applicable_agents_bulk,
+	get_assignment_map,
+	get_covering_territories,
+)
+from sales_agent_commission.commission_calculator import calculate_invoice_commissions
+
+CHECKPOINT_KEY = "agent_commission_backfill_checkpoint"
+DEFAULT_CHUNK_SIZE = 500
+
+
+def get_checkpoint(from_date, to_date):
+	"""Get the saved checkpoint of a run over the same date range"""
+	checkpoint = frappe.db.get_global(CHECKPOINT_KEY)
+	if not checkpoint:
+		return None
+
+	checkpoint = json.loads(checkpoint)
+	if checkpoint.get("from_date") != str(from_date) or checkpoint.get("to_date") != str(to_date):
+		return None
+
+	return checkpoint
+
+
+def save_checkpoint(checkpoint):
+	frappe.db.set_global(CHECKPOINT_KEY, json.dumps(checkpoint, default=str))
+
+
+def clear_checkpoint():
+	frappe.db.set_global(CHECKPOINT_KEY, None)
+
+
+def backfill_commissions(from_date, to_date, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, resume=True):
+	"""Create missing Agent Commission Entries for invoices posted between two dates"""
+	from_date, to_date = getdate(from_date), getdate(to_date)
+	chunk_size = cint(chunk_size) or DEFAULT_CHUNK_SIZE
+
+	checkpoint = get_checkpoint(from_date, to_date) if resume else None
+	if not checkpoint:
+		checkpoint = {
+			"from_date": str(from_date),
+			"to_date": str(to_date),
+			"last_posting_date": None,
+			"last_invoice": None,
+			"invoices": 0,
+			"entries": 0
+		}
+
+	started = time.monotonic()
+	processed = 0
+
+	workers = cint(workers) or os.cpu_count() or 1
+
+	# Workers only run the pure calculation core, spawn keeps them from
+	# inheriting the database connection
+	with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+		while True:
+			invoices = get_invoice_chunk(from_date, to_date, checkpoint, chunk_size)
+			if not invoices:
+				break
+
+			entries = process_chunk(invoices, pool, workers)
+
+			last = invoices[-1]
+			checkpoint.update({
+				"last_posting_date": str(last.posting_date),
+				"last_invoice": last.name,
+				"invoices": checkpoint["invoices"] + len(invoices),
+				"entries": checkpoint["entries"] + entries
+			})
+			save_checkpoint(checkpoint)
+			frappe.db.commit()
+
+			processed += len(invoices)
+			elapsed = time.monotonic() - started
+			frappe.publish_realtime("agent_commission_backfill_progress", {
+				"invoices": checkpoint["invoices"],
+				"entries": checkpoint["entries"],
+				"last_posting_date": checkpoint["last_posting_date"],
+				"invoices_per_second": processed / elapsed if elapsed else 0
+			})
+
+	clear_checkpoint()
+	frappe.db.commit()
+
+	elapsed = time.monotonic() - started
+	return {
+		"invoices": checkpoint["invoices"],
+		"entries": checkpoint["entries"],
+		"seconds": elapsed,
+		"invoices_per_second": processed / elapsed if elapsed else 0
+	}
+
+
+def get_invoice_chunk(from_date, to_date, checkpoint, chunk_size):
+	"""Get the next chunk of submitted invoices after the checkpoint"""
+	conditions = ""
+	if checkpoint.get("last_invoice"):
+		conditions = """AND (posting_date > %(last_posting_date)s
+			OR (posting_date = %(last_posting_date)s AND name > %(last_invoice)s))"""
+
+	return frappe.db.sql("""
+		SELECT name, customer, territory, posting_date, grand_total, outstanding_amount, currency
+		FROM `tabSales Invoice`
+		WHERE docstatus = 1
+		AND posting_date BETWEEN %(from_date)s AND %(to_date)s
+		{conditions}
+		ORDER BY posting_date, name
+		LIMIT %(chunk_size)s
+	""".format(conditions=conditions), {
+		"from_date": from_date,
+		"to_date": to_date,
+		"last_posting_date": checkpoint.get("last_posting_date"),
+		"last_invoice": checkpoint.get("last_invoice"),
+		"chunk_size": chunk_size
+	}, as_dict=1)
+
+
+def process_chunk(invoices, pool, workers):
+	"""Calculate and write commission entries for a chunk of invoices"""
+	existing = set(frappe.get_all("Agent Commission Entry",
+		filters={"sales_invoice": ["in", [d.name for d in invoices]], "docstatus": 1},
+		pluck="sales_invoice",
+		distinct=True))
+	invoices = [d for d in invoices if d.name not in existing]
+	if not invoices:
+		return 0
+
+	names = [d.name for d in invoices]
+	lines = get_invoice_lines(names)
+	taxes = get_invoice_taxes(names)
+
+	assignment_map = get_assignment_map()
+	applicable_agents = get_applicable_agents_bulk(invoices)
+	rate_indexes = get_rate_indexes({agent for agents in applicable_agents.values() for agent in agents})
+
+	batch = [
+		(
+			d.name,
+			d.customer,
+			get_covering_territories(assignment_map, d.territory),
+			applicable_agents[d.name],
+			lines.get(d.name, [])
+		)
+		for d in invoices
+		if applicable_agents[d.name]
+	]
+
+	size = max(1, -(-len(batch) // workers))
+	results = []
+	for chunk_results in pool.map(calculate_invoice_commissions,
+		[batch[i:i + size] for i in range(0, len(batch), size)],
+		[rate_indexes] * workers):
+		results.extend(chunk_results)
+
+	return write_commission_entries({d.name: d for d in invoices}, taxes, results)
+
+
+def get_invoice_lines(invoices):
+	"""Get (item_group, amount) lines of invoices with one query"""
+	items = frappe.db.sql("""
+		SELECT sii.parent, IFNULL(NULLIF(sii.item_group, ''), i.item_group) AS item_group, sii.amount
+		FROM `tabSales Invoice Item` sii
+		LEFT JOIN `tabItem` i ON i.name = sii.item_code
+		WHERE sii.parenttype = 'Sales Invoice'
+		AND sii.parent IN %(invoices)s
+	""", {"invoices": tuple(invoices)}, as_dict=1)
+
+	lines = {}
+	for item in items:
+		lines.setdefault(item.parent, []).append((item.item_group, item.amount))
+
+	return lines
+
+
+def get_invoice_taxes(invoices):
+	"""Get tax rows of invoices with one query"""
+	rows = frappe.db.sql("""
+		SELECT parent, account_head, charge_type, description, tax_amount
+		FROM `tabSales Taxes and Charges`
+		WHERE parenttype = 'Sales Invoice'
+		AND parent IN %(invoices)s
+	""", {"invoices": tuple(invoices)}, as_dict=1)
+
+	taxes = {}
+	for row in rows:
+		taxes.setdefault(row.parent, []).append(row)
+
+	return taxes
+
+
+def get_rate_indexes(agents):
+	"""Get compiled rate indexes of agents"""
+	from sales_agent_commission.doctype.agent_master.agent_master import get_agent_rate_index
+
+	return {agent: get_agent_rate_index(agent) for agent in agents}
+
+
+def write_commission_entries(invoices, taxes, results):
+	"""Write calculated commissions in bulk and stamp the invoice summary fields"""
+	from sales_agent_commission.charge_classifier import get_charge_classifier, get_invoice_charges
+	from sales_agent_commission.commission_writer import bulk_insert_commission_entries
+	from sales_agent_commission.doctype.agent_commission_entry.agent_commission_entry import (
+		make_commission_entry,
+	)
+
+	classifier = get_charge_classifier()
+	charges = {}
+	entries = []
+	for invoice_name, agent, rows in results:
+		invoice = invoices[invoice_name]
+		if invoice_name not in charges:
+			invoice.taxes = taxes.get(invoice_name, [])
+			charges[invoice_name] = get_invoice_charges(invoice, classifier)
+
+		entries.append(make_commission_entry(invoice, agent, [row.as_detail() for row in rows],
+			*charges[invoice_name]))
+
+	bulk_insert_commission_entries(entries)
+
+	summaries = {}
+	for entry in entries:
+		summary = summaries.setdefault(entry.sales_invoice, {"agents": [], "total": 0})
+		summary["agents"].append(entry.agent_name or entry.agent)
+		summary["total"] += entry.commission_amount or 0
+
+	for invoice_name, summary in summaries.items():
+		frappe.db.set_value("Sales Invoice", invoice_name, {
+			"commission_entries_created": 1,
+			"applicable_agents": ", ".join(summary["agents"]),
+			"total_commission_amount": summary["total"]
+		}, update_modified=False)
+
+	return len(entries)
+
+
+@frappe.whitelist()
+def enqueue_backfill(from_date, to_date, chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+	"""Run the commission backfill in a background job"""
+	frappe.only_for(("System Manager", "Accounts Manager"))
+
+	frappe.enqueue(
+		backfill_commissions,
+		queue="long",
+		timeout=24 * 3600,
+		job_id=f"agent_commission_backfill::{from_date}::{to_date}",
+		deduplicate=True,
+		from_date=from_date,
+		to_date=to_date,
+		chunk_size=chunk_size,
+		workers=workers
+	)
+
+	frappe.msgprint(_("Commission backfill from {0} to {1} has been queued").format(from_date, to_date))
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+"""Bank payment files for Agent Payout Runs.
+
+Submitted payments of a run are streamed through a server side cursor and
+written row by row, starting a new file whenever the bank's maximum batch
+size is reached. Bank details of all agents are read with one query.
+"""
+
+from __future__ import unicode_literals
+import csv
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, getdate, now_datetime
+
+DEFAULT_MAX_BATCH_SIZE = 1000
+
+class BankFileWriter(object):
+    """Writes the payments of one file. Subclasses lay out the rows in
+    `write_payment(payment, account)`."""
+    extension = "txt"
+
+    def __init__(self, path, run_doc, count):
+        self.file = open(path, "w", encoding="utf-8", newline="")
+        self.batch_id = os.path.splitext(os.path.basename(path))[0]
+        self.run_doc = run_doc
+        self.count = count
+
+    def write_header(self):
+        pass
+
+    def write_footer(self):
+        pass
+
+    def close(self):
+        self.write_footer()
+        self.file.close()
+
+class CSVBankFileWriter(BankFileWriter):
+    extension = "csv"
+    columns = ("reference", "account_name", "account_number", "bank_name", "ifsc_code",
+        "swift_code", "amount", "currency", "payment_date")
+
+    def __init__(self, path, run_doc, count):
+        super(CSVBankFileWriter, self).__init__(path, run_doc, count)
+        self.writer = csv.writer(self.file)
+
+    def write_header(self):
+        self.writer.writerow(self.columns)
+
+    def write_payment(self, payment, account):
+        self.writer.writerow(get_payment_values(payment, account)[column] for column in self.columns)
+
+class FixedWidthBankFileWriter(BankFileWriter):
+    extension = "txt"
+    # (field, width), amounts are right aligned and zero padded
+    layout = (
+        ("reference", 20),
+        ("account_number", 34),
+        ("ifsc_code", 11),
+        ("swift_code", 11),
+        ("account_name", 35),
+        ("amount", 15),
+        ("currency", 3),
+        ("payment_date", 8)
+    )
+
+    def write_payment(self, payment, account):
+        values = get_payment_values(payment, account)
+        values["payment_date"] = values["payment_date"].replace("-", "")
+
+        line = []
+        for field, width in self.layout:
+            value = str(values[field] or "")[:width]
+            line.append(value.rjust(width, "0") if field == "amount" else value.ljust(width))
+
+        self.file.write("".join(line) + "\r\n")
+
+class XMLBankFileWriter(BankFileWriter):
+    """ISO 20022 customer credit transfer initiation (pain.001.001.03)"""
+    extension = "xml"
+
+    def write_header(self):
+        run_doc = self.run_doc
+        debtor_account = get_company_account_number(run_doc.company_bank_account)
+
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Document xmlns="urn:iso:std:iso:20022:tech:xsd:pain.001.001.03">\n'
+            "<CstmrCdtTrfInitn>\n")
+        self.file.write("<GrpHdr><MsgId>{0}</MsgId><CreDtTm>{1}</CreDtTm><NbOfTxs>{2}</NbOfTxs>"
+            "<InitgPty><Nm>{3}</Nm></InitgPty></GrpHdr>\n".format(escape(self.batch_id),
+                now_datetime().strftime("%Y-%m-%dT%H:%M:%S"), self.count, escape(run_doc.company)))
+        self.file.write("<PmtInf><PmtInfId>{0}</PmtInfId><PmtMtd>TRF</PmtMtd><NbOfTxs>{1}</NbOfTxs>"
+            "<ReqdExctnDt>{2}</ReqdExctnDt><Dbtr><Nm>{3}</Nm></Dbtr>"
+            "<DbtrAcct><Id><Othr><Id>{4}</Id></Othr></Id></DbtrAcct>"
+            "<DbtrAgt><FinInstnId/></DbtrAgt>\n".format(escape(self.batch_id), self.count,
+                getdate(run_doc.payment_date), escape(run_doc.company), escape(debtor_account or "")))
+
+    def write_payment(self, payment, account):
+        values = {key: escape(value or "") for key, value in get_payment_values(payment, account).items()}
+
+        if values["swift_code"]:
+            institution = "<BIC>{0}</BIC>".format(values["swift_code"])
+        else:
+            institution = "<Othr><Id>{0}</Id></Othr>".format(values["ifsc_code"])
+
+        self.file.write("<CdtTrfTxInf><PmtId><EndToEndId>{reference}</EndToEndId></PmtId>"
+            "<Amt><InstdAmt Ccy={currency}>{amount}</InstdAmt></Amt>"
+            "<CdtrAgt><FinInstnId>{institution}</FinInstnId></CdtrAgt>"
+            "<Cdtr><Nm>{account_name}</Nm></Cdtr>"
+            "<CdtrAcct><Id><Othr><Id>{account_number}</Id></Othr></Id></CdtrAcct>"
+            "<RmtInf><Ustrd>{reference}</Ustrd></RmtInf></CdtTrfTxInf>\n".format(
+                institution=institution, currency=quoteattr(payment.currency or ""), **values))
+
+    def write_footer(self):
+        self.file.write("</PmtInf>\n</CstmrCdtTrfInitn>\n</Document>\n")
+
+BANK_FILE_WRITERS = {
+    "CSV": CSVBankFileWriter,
+    "Fixed Width": FixedWidthBankFileWriter,
+    "XML": XMLBankFileWriter
+}
+
+def get_payment_values(payment, account):
+    return {
+        "reference": payment.name,
+        "account_name": account.account_name or payment.agent_name,
+        "account_number": account.account_number,
+        "bank_name": account.bank_name,
+        "ifsc_code": account.ifsc_code,
+        "swift_code": account.swift_code,
+        "amount": "%.2f" % flt(payment.total_amount, 2),
+        "currency": payment.currency,
+        "payment_date": str(getdate(payment.payment_date))
+    }
+
+def get_company_account_number(bank_account):
+    if not bank_account:
+        return None
+
+    iban, account_number = frappe.db.get_value("Bank Account", bank_account, ["iban", "bank_account_no"])
+    return iban or account_number
+
+def get_agent_bank_accounts(run):
+    """Get the bank accounts of all agents of a run in one query, keyed by
+    agent and account number, with the primary account under None"""
+    accounts = frappe.db.sql("""
+        SELECT parent AS agent, account_name, account_number, bank_name, ifsc_code, swift_code, is_primary
+        FROM `tabAgent Bank Account`
+        WHERE parenttype = 'Agent Master'
+        AND parent IN (
+            SELECT agent
+            FROM `tabAgent Payout Run Item`
+            WHERE parent = %s
+            AND parenttype = 'Agent Payout Run'
+        )
+        ORDER BY parent, is_primary DESC, idx
+    """, run, as_dict=1)
+
+    accounts_by_agent = {}
+    for account in accounts:
+        agent_accounts = accounts_by_agent.setdefault(account.agent, {})
+        agent_accounts.setdefault(account.account_number, account)
+        if account.is_primary:
+            agent_accounts.setdefault(None, account)
+
+    return accounts_by_agent
+
+# Payments are exported only when their agent has the recorded or a primary bank account
+PAYMENTS_QUERY = """
+    SELECT {fields}
+    FROM `tabAgent Payout Run Item` item
+    INNER JOIN `tabAgent Commission Payment` payment ON payment.name = item.payment
+    WHERE item.parent = %s
+    AND item.parenttype = 'Agent Payout Run'
+    AND payment.docstatus = 1
+    AND {exists} (
+        SELECT 1
+        FROM `tabAgent Bank Account` account
+        WHERE account.parent = payment.agent
+        AND account.parenttype = 'Agent Master'
+        AND (account.is_primary = 1 OR account.account_number = payment.agent_bank_account)
+    )
+"""
+
+def export_bank_files(run, file_format=None, max_batch_size=None):
+    """Write the submitted payments of a payout run to bank files attached to
+    the run. Returns the file URLs and the payments left out for want of a
+    bank account."""
+    run_doc = frappe.get_doc("Agent Payout Run", run)
+    file_format = file_format or run_doc.bank_file_format or "CSV"
+    writer_class = BANK_FILE_WRITERS.get(file_format)
+    if not writer_class:
+        frappe.throw(_("Bank file format {0} is not supported").format(file_format))
+
+    max_batch_size = cint(max_batch_size) or cint(run_doc.max_batch_size) or DEFAULT_MAX_BATCH_SIZE
+
+    accounts = get_agent_bank_accounts(run)
+    count = frappe.db.sql(PAYMENTS_QUERY.format(fields="COUNT(*)", exists="EXISTS"), run)[0][0]
+    missing = frappe.db.sql_list(PAYMENTS_QUERY.format(fields="payment.name", exists="NOT EXISTS"), run)
+    if not count:
+        frappe.throw(_("Payout Run {0} has no submitted payments with a bank account").format(run))
+
+    prefix = "{0}-{1}".format(run, now_datetime().strftime("%Y%m%d%H%M%S"))
+    files_path = frappe.get_site_path("private", "files")
+    file_names = []
+    writer = None
+    written = exported = 0
+
+    try:
+        with frappe.db.unbuffered_cursor():
+            for payment in frappe.db.sql(PAYMENTS_QUERY.format(fields="""payment.name, payment.agent,
+                payment.agent_name, payment.total_amount, payment.currency, payment.payment_date,
+                payment.agent_bank_account""", exists="EXISTS") + " ORDER BY item.idx", run,
+                as_dict=1, as_iterator=True):
+                agent_accounts = accounts[payment.agent]
+                account = agent_accounts.get(payment.agent_bank_account) or agent_accounts[None]
+
+                if writer is None or written == max_batch_size:
+                    if writer:
+                        writer.close()
+
+                    file_names.append("{0}-{1:03d}.{2}".format(prefix, len(file_names) + 1, writer_class.extension))
+                    writer = writer_class(os.path.join(files_path, file_names[-1]), run_doc,
+                        min(max_batch_size, count - max_batch_size * (len(file_names) - 1)))
+                    writer.write_header()
+                    written = 0
+
+                writer.write_payment(payment, account)
+                written += 1
+                exported += 1
+    finally:
+        if writer:
+            writer.close()
+
+    # The headers carry the count taken before the stream, so a payment
+    # submitted or cancelled in between would make the files inconsistent
+    if exported != count:
+        for file_name in file_names:
+            os.remove(os.path.join(files_path, file_name))
+        frappe.throw(_("Payments of Payout Run {0} changed while its bank files were written, please export again")
+            .format(run))
+
+    # Files are attached once the stream is consumed and the connection is free
+    file_urls = []
+    for file_name in file_names:
+        file_doc = frappe.get_doc({
+            "doctype": "File",
+            "file_name": file_name,
+            "file_url": "/private/files/" + file_name,
+            "is_private": 1,
+            "attached_to_doctype": "Agent Payout Run",
+            "attached_to_name": run
+        })
+        file_doc.insert(ignore_permissions=True)
+        file_urls.append(file_doc.file_url)
+
+    return {"files": file_urls, "missing_bank_accounts": missing}
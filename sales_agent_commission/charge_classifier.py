@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import cint, flt
+
+CHARGE_CLASSIFIER_CACHE_KEY = "agent_commission_charge_classifier"
+FREIGHT = "Freight"
+LOGISTICS = "Logistics"
+IGNORE = "Ignore"
+
+FREIGHT_KEYWORDS = ("freight", "shipping")
+LOGISTICS_KEYWORDS = ("logistics", "handling")
+
+def build_charge_classifier():
+    """Compile the charge mappings of Agent Commission Settings into
+    account head and charge type lookups"""
+    settings = frappe.get_single("Agent Commission Settings")
+
+    classifier = {
+        "account_head": {},
+        "charge_type": {},
+        "match_descriptions": cint(settings.match_charge_descriptions)
+    }
+    for row in settings.charge_mappings:
+        # First mapping of an account head or charge type wins
+        if row.account_head:
+            classifier["account_head"].setdefault(row.account_head, row.classification)
+        elif row.charge_type:
+            classifier["charge_type"].setdefault(row.charge_type, row.classification)
+
+    return classifier
+
+def get_charge_classifier():
+    return frappe.cache().get_value(CHARGE_CLASSIFIER_CACHE_KEY, build_charge_classifier)
+
+def clear_charge_classifier():
+    frappe.cache().delete_value(CHARGE_CLASSIFIER_CACHE_KEY)
+
+def classify_charge(classifier, tax):
+    """Classify a tax row as Freight, Logistics or Ignore.
+
+    Mapped account heads take precedence over mapped charge types. Unmapped
+    rows fall back to description keywords, with freight keywords checked
+    first so a row is never counted as both."""
+    classification = classifier["account_head"].get(tax.get("account_head")) \
+        or classifier["charge_type"].get(tax.get("charge_type"))
+    if classification:
+        return classification
+
+    if classifier["match_descriptions"]:
+        description = (tax.get("description") or "").lower()
+        if any(keyword in description for keyword in FREIGHT_KEYWORDS):
+            return FREIGHT
+        if any(keyword in description for keyword in LOGISTICS_KEYWORDS):
+            return LOGISTICS
+
+    return IGNORE
+
+def get_invoice_charges(invoice, classifier=None):
+    """Get (freight, logistics) charges of an invoice in a single pass over its taxes"""
+    if classifier is None:
+        classifier = get_charge_classifier()
+
+    charges = {FREIGHT: 0, LOGISTICS: 0}
+    for tax in invoice.get("taxes") or []:
+        classification = classify_charge(classifier, tax)
+        if classification in charges:
+            charges[classification] += flt(tax.get("tax_amount"))
+
+    return charges[FREIGHT], charges[LOGISTICS]
@@ -0,0 +1,65 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("backfill-agent-commissions")
+@click.option("--from-date", required=True, help="First posting date to backfill")
+@click.option("--to-date", required=True, help="Last posting date to backfill")
+@click.option("--chunk-size", default=500, type=int, help="Invoices per chunk")
+@click.option("--workers", default=0, type=int, help="Calculation processes, defaults to CPU count")
+@click.option("--restart", is_flag=True, default=False, help="Ignore a saved checkpoint and start over")
+@pass_context
+def backfill_agent_commissions(context, from_date, to_date, chunk_size, workers, restart):
+	"""Create missing Agent Commission Entries for historical Sales Invoices"""
+	from sales_agent_commission.backfill import backfill_commissions
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		result = backfill_commissions(from_date, to_date, chunk_size=chunk_size,
+			workers=workers, resume=not restart)
+		click.echo(
+			"Backfilled {invoices} invoices, {entries} commission entries "
+			"in {seconds:.1f}s ({invoices_per_second:.1f} invoices/s)".format(**result)
+		)
+	finally:
+		frappe.destroy()
+
+
+@click.command("repair-agent-ledger")
+@click.option("--agent", "agents", multiple=True, help="Agent to repair, may be repeated. Defaults to all agents")
+@click.option("--batch-size", default=1000, type=int, help="Corrected rows per UPDATE batch")
+@click.option("--background", is_flag=True, default=False, help="Repair agents in parallel background jobs")
+@pass_context
+def repair_agent_ledger(context, agents, batch_size, background):
+	"""Recompute the running balances stored on Agent Ledger Entries"""
+	from sales_agent_commission import agent_ledger
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		agents = list(agents) or agent_ledger.get_ledger_agents()
+
+		if background:
+			agent_ledger.enqueue_ledger_repair_jobs(agents, batch_size)
+			frappe.db.commit()
+			click.echo(f"Queued ledger repair for {len(agents)} agents")
+			return
+
+		total = 0
+		for agent in agents:
+			drifted = agent_ledger.repair_agent_ledger(agent, batch_size)
+			frappe.db.commit()
+			total += drifted
+			click.echo(f"{agent}: {drifted} drifted rows")
+
+		click.echo(f"Repaired {total} drifted rows across {len(agents)} agents")
+	finally:
+		frappe.destroy()
+
+
+commands = [backfill_agent_commissions, repair_agent_ledger]
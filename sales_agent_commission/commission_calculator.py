@@ -0,0 +1,241 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""Commission calculation core.
+
+Plain records in, commission rows out: nothing in this module touches the
+database or imports frappe, so it can be used for bulk recalculation,
+simulation and profiling without a site. Both Agent Commission Entry and
+Sales Agent Commission Entry calculate through these functions.
+"""
+
+from sales_agent_commission.commission_tiers import (
+	TierSchedule,
+	apply_commission_limits,
+	calculate_tiered_commissions,
+)
+
+
+def _float(value):
+	return float(value or 0)
+
+
+class InvoiceLine:
+	"""A Sales Invoice line reduced to the fields used for commission"""
+
+	__slots__ = ("item_code", "item_name", "item_group", "qty", "rate", "amount", "base_amount")
+
+	def __init__(self, item_code, item_group, qty=0, rate=0, amount=0, base_amount=0, item_name=None):
+		self.item_code = item_code
+		self.item_name = item_name
+		self.item_group = item_group
+		self.qty = _float(qty)
+		self.rate = _float(rate)
+		self.amount = _float(amount)
+		self.base_amount = _float(base_amount)
+
+	@classmethod
+	def from_row(cls, row, item_group=None):
+		"""Build from a Sales Invoice Item row or dict"""
+		return cls(
+			row.get("item_code"),
+			item_group or row.get("item_group"),
+			qty=row.get("qty"),
+			rate=row.get("rate"),
+			amount=row.get("amount"),
+			base_amount=row.get("base_amount"),
+			item_name=row.get("item_name")
+		)
+
+
+class RateRule:
+	"""A Sales Agent Commission Rate row with its tier table compiled"""
+
+	__slots__ = (
+		"item_group", "commission_percentage", "fixed_amount", "minimum_amount",
+		"maximum_amount", "effective_from", "effective_to", "tier_schedule"
+	)
+
+	def __init__(self, item_group, commission_percentage=0, fixed_amount=0, minimum_amount=0,
+		maximum_amount=0, tiers=None, effective_from=None, effective_to=None):
+		self.item_group = item_group
+		self.commission_percentage = _float(commission_percentage)
+		self.fixed_amount = _float(fixed_amount)
+		self.minimum_amount = _float(minimum_amount)
+		self.maximum_amount = _float(maximum_amount)
+		self.effective_from = effective_from
+		self.effective_to = effective_to
+		self.tier_schedule = TierSchedule(tiers or [])
+
+	@classmethod
+	def from_row(cls, row, effective_from=None, effective_to=None):
+		"""Build from a Sales Agent Commission Rate row or dict"""
+		return cls(
+			row.get("item_group"),
+			commission_percentage=row.get("commission_percentage"),
+			fixed_amount=row.get("fixed_amount"),
+			minimum_amount=row.get("minimum_amount"),
+			maximum_amount=row.get("maximum_amount"),
+			tiers=[
+				(d.get("from_amount"), d.get("to_amount"), d.get("commission_percentage"))
+				for d in (row.get("tiered_rates") or [])
+			],
+			effective_from=effective_from,
+			effective_to=effective_to
+		)
+
+
+def to_rate_rule(rate):
+	"""Get a RateRule for a rate row, converting document rows as needed"""
+	return rate if isinstance(rate, RateRule) else RateRule.from_row(rate)
+
+
+class CommissionRow:
+	"""Commission calculated for an item group or an invoice line"""
+
+	__slots__ = ("item_group", "amount", "commission_rate", "commission_amount", "line")
+
+	def __init__(self, item_group, amount, commission_rate, commission_amount, line=None):
+		self.item_group = item_group
+		self.amount = amount
+		self.commission_rate = commission_rate
+		self.commission_amount = commission_amount
+		self.line = line
+
+	def as_detail(self):
+		"""Values of an Agent Commission Detail row"""
+		return {
+			"item_group": self.item_group,
+			"amount": self.amount,
+			"commission_rate": self.commission_rate,
+			"commission_amount": self.commission_amount
+		}
+
+
+# Agent Master pipeline
+
+def group_line_amounts(lines):
+	"""Sum line amounts by item group"""
+	totals = {}
+	for line in lines:
+		totals[line.item_group] = totals.get(line.item_group, 0) + line.amount
+
+	return totals
+
+
+def resolve_commission_rate(rate_index, item_group, customer=None, territory=None):
+	"""Resolve a commission rate from a compiled Agent Master rate index.
+
+	Customer specific rates take precedence over Territory rates, which take
+	precedence over the default rate for the item group. `territory` may be a
+	list of territories ordered nearest first, in which case the rate of the
+	nearest territory wins."""
+	if customer:
+		key = (item_group, "Customer", customer)
+		if key in rate_index:
+			return rate_index[key]
+
+	territories = [territory] if isinstance(territory, str) else (territory or [])
+	for terr in territories:
+		key = (item_group, "Territory", terr)
+		if key in rate_index:
+			return rate_index[key]
+
+	return rate_index.get((item_group, "All", None), 0)
+
+
+def calculate_group_commissions(item_group_totals, rate_index, customer=None, territories=None):
+	"""Commission per item group for one agent"""
+	rows = []
+	for item_group, amount in item_group_totals.items():
+		rate = resolve_commission_rate(rate_index, item_group, customer, territories)
+		if rate > 0:
+			rows.append(CommissionRow(item_group, amount, rate, amount * rate / 100))
+
+	return rows
+
+
+def calculate_invoice_commissions(invoices, rate_indexes):
+	"""Commission per agent and item group for a batch of invoices.
+
+	`invoices` is a list of (invoice, customer, territories, agents, lines)
+	tuples with lines as (item_group, amount) pairs, and `rate_indexes` maps
+	each agent to its compiled rate index. Returns (invoice, agent, rows)
+	tuples for every agent earning commission on an invoice. Only plain
+	values are passed in and out, so batches can be sent to worker processes."""
+	results = []
+	for invoice, customer, territories, agents, lines in invoices:
+		item_group_totals = {}
+		for item_group, amount in lines:
+			item_group_totals[item_group] = item_group_totals.get(item_group, 0) + _float(amount)
+
+		for agent in agents:
+			rows = calculate_group_commissions(item_group_totals, rate_indexes.get(agent) or {},
+				customer, territories)
+			if rows:
+				results.append((invoice, agent, rows))
+
+	return results
+
+
+# Sales Agent pipeline
+
+def calculate_commission(base_amount, qty, rule, calculation_method):
+	"""Commission for a single line under a rate rule, with min/max limits"""
+	if calculation_method == "Percentage":
+		commission = _float(base_amount) * rule.commission_percentage / 100
+	elif calculation_method == "Fixed Amount":
+		commission = rule.fixed_amount * _float(qty)
+	elif calculation_method == "Tiered":
+		commission = rule.tier_schedule.commission(base_amount)
+	else:
+		commission = 0
+
+	return apply_commission_limits(commission, rule.minimum_amount, rule.maximum_amount)
+
+
+def calculate_line_commissions(lines, get_rule, calculation_method):
+	"""Commission for every line that has a rate rule.
+
+	`get_rule` is called with an item group and returns the applicable
+	RateRule or None."""
+	rows = []
+	rules = {}
+	for line in lines:
+		if line.item_group not in rules:
+			rules[line.item_group] = get_rule(line.item_group)
+
+		rule = rules[line.item_group]
+		if rule:
+			rows.append(CommissionRow(
+				line.item_group,
+				line.base_amount,
+				rule.commission_percentage or 0,
+				calculate_commission(line.base_amount, line.qty, rule, calculation_method),
+				line
+			))
+
+	return rows
+
+
+def calculate_commissions_batch(lines, calculation_method):
+	"""Commission for many (line, rule) pairs, as `calculate_commission` would
+	give for each. Returns (line, commission) pairs, skipping lines without a
+	rule. Tiered lines sharing a rule are resolved in one vectorized call."""
+	if calculation_method != "Tiered":
+		return [
+			(line, calculate_commission(line.base_amount, line.qty, rule, calculation_method))
+			for line, rule in lines if rule
+		]
+
+	batches = {}
+	for line, rule in lines:
+		if rule:
+			batches.setdefault(id(rule), (rule, []))[1].append(line)
+
+	results = []
+	for rule, rule_lines in batches.values():
+		commissions = calculate_tiered_commissions(rule, [line.base_amount for line in rule_lines])
+		results.extend((line, float(commission)) for line, commission in zip(rule_lines, commissions))
+
+	return results
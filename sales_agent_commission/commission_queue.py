@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import cint
+
+PENDING_INVOICES_KEY = "agent_commission_pending_invoices"
+FAILED_INVOICES_KEY = "agent_commission_failed_invoices"
+BATCH_JOB_ID = "agent_commission_batch"
+DEFAULT_BATCH_SIZE = 100
+
+def is_background_creation_enabled():
+    """Check if commission entries are created by background workers"""
+    return cint(frappe.db.get_single_value("Agent Commission Settings", "create_commissions_in_background"))
+
+def enqueue_commission_creation(sales_invoice):
+    """Queue an invoice for commission creation.
+
+    The pending queue is a set keyed by invoice name, so submitting or
+    retrying the same invoice never queues it twice. The invoice is added
+    only once the submit commits, otherwise a running worker could see it
+    before it is readable, skip it and drop it from the queue."""
+    frappe.db.after_commit.add(lambda: frappe.cache().sadd(PENDING_INVOICES_KEY, sales_invoice))
+    enqueue_batch_job()
+
+def dequeue_commission_creation(sales_invoice):
+    """Drop an invoice from the pending queue, e.g. when it is cancelled"""
+    frappe.cache().srem(PENDING_INVOICES_KEY, sales_invoice)
+    frappe.cache().srem(FAILED_INVOICES_KEY, sales_invoice)
+
+def enqueue_batch_job():
+    """Start the batch worker unless one is already queued or running"""
+    frappe.enqueue(
+        "sales_agent_commission.commission_queue.process_pending_invoices",
+        queue="short",
+        job_id=BATCH_JOB_ID,
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
+
+def requeue_pending_invoices():
+    """Scheduled sweep retrying failed invoices and restarting the batch
+    worker for invoices left in the queue"""
+    failed = frappe.cache().smembers(FAILED_INVOICES_KEY)
+    if failed:
+        frappe.cache().sadd(PENDING_INVOICES_KEY, *failed)
+        frappe.cache().srem(FAILED_INVOICES_KEY, *failed)
+
+    if frappe.cache().scard(PENDING_INVOICES_KEY):
+        enqueue_batch_job()
+
+def get_pending_invoices(limit):
+    invoices = frappe.cache().smembers(PENDING_INVOICES_KEY) or []
+    return sorted(frappe.safe_decode(d) for d in invoices)[:limit]
+
+def process_pending_invoices():
+    """Create commission entries for queued invoices in batches"""
+    batch_size = cint(frappe.db.get_single_value("Agent Commission Settings", "commission_batch_size")) \
+        or DEFAULT_BATCH_SIZE
+
+    while True:
+        invoices = get_pending_invoices(batch_size)
+        if not invoices:
+            break
+
+        # Failed invoices wait for the scheduled sweep instead of being
+        # retried in this loop
+        failed = process_invoice_batch(invoices)
+        if failed:
+            frappe.cache().sadd(FAILED_INVOICES_KEY, *failed)
+        frappe.cache().srem(PENDING_INVOICES_KEY, *invoices)
+
+def process_invoice_batch(invoices):
+    """Create commission entries for a batch of invoices, committing per
+    invoice. Returns the invoices that failed."""
+    from sales_agent_commission.overrides import create_commissions_for_invoice
+
+    submitted = set(frappe.get_all("Sales Invoice",
+        filters={"name": ["in", invoices], "docstatus": 1},
+        pluck="name"))
+    processed = set(frappe.get_all("Agent Commission Entry",
+        filters={"sales_invoice": ["in", invoices], "docstatus": 1},
+        pluck="sales_invoice",
+        distinct=True))
+
+    failed = []
+    for invoice in invoices:
+        # Already processed or no longer submitted
+        if invoice not in submitted or invoice in processed:
+            continue
+
+        try:
+            create_commissions_for_invoice(invoice, bulk=True)
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(title=f"Agent commission creation failed for {invoice}")
+            failed.append(invoice)
+
+    return failed
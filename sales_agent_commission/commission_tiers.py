@@ -0,0 +1,150 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""Tiered commission engine.
+
+A tier table is compiled once into sorted boundaries with the commission
+accumulated up to each boundary and the combined rate of the tiers active
+after it. A single amount is then resolved with one bisect, and arrays of
+amounts are resolved in one vectorized call when NumPy is available.
+"""
+
+from bisect import bisect_left
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class TierSchedule:
+	"""Compiled tier table of a commission rate row"""
+
+	__slots__ = ("boundaries", "at_boundary", "base", "slope")
+
+	def __init__(self, tiers):
+		"""`tiers` is an iterable of (from_amount, to_amount, commission_percentage)"""
+		compiled = []
+		for from_amount, to_amount, percentage in tiers:
+			compiled.append((
+				float(from_amount or 0),
+				float(to_amount) if to_amount else float("inf"),
+				float(percentage or 0) / 100
+			))
+
+		boundaries = sorted(
+			{d[0] for d in compiled} | {d[1] for d in compiled if d[1] != float("inf")}
+		)
+
+		# Commission exactly at each boundary, its limit just above the boundary
+		# and the combined rate of the tiers running past it
+		at_boundary, base, slope = [], [], []
+		for boundary in boundaries:
+			at, above, rate = 0.0, 0.0, 0.0
+			for tier_from, tier_to, tier_rate in compiled:
+				if tier_from > boundary:
+					continue
+				tier_amount = (min(boundary, tier_to) - tier_from) * tier_rate
+				above += tier_amount
+				if tier_from < boundary:
+					at += tier_amount
+				if tier_to > boundary:
+					rate += tier_rate
+			at_boundary.append(at)
+			base.append(above)
+			slope.append(rate)
+
+		self.boundaries = boundaries
+		self.at_boundary = at_boundary
+		self.base = base
+		self.slope = slope
+
+	@classmethod
+	def from_rows(cls, tier_rows):
+		"""Compile from Sales Agent Commission Tier rows"""
+		return cls((d.from_amount, d.to_amount, d.commission_percentage) for d in tier_rows)
+
+	def commission(self, amount):
+		"""Tiered commission for a single amount"""
+		amount = float(amount or 0)
+		boundaries = self.boundaries
+
+		idx = bisect_left(boundaries, amount)
+		if idx < len(boundaries) and boundaries[idx] == amount:
+			return self.at_boundary[idx]
+
+		idx -= 1
+		if idx < 0:
+			return 0.0
+
+		return self.base[idx] + self.slope[idx] * (amount - boundaries[idx])
+
+	def commissions(self, amounts):
+		"""Tiered commission for an array of amounts"""
+		if numpy is None:
+			return [self.commission(amount) for amount in amounts]
+
+		amounts = numpy.asarray(amounts, dtype=float)
+		if not self.boundaries:
+			return numpy.zeros_like(amounts)
+
+		boundaries = numpy.asarray(self.boundaries)
+		last = len(boundaries) - 1
+
+		idx = numpy.searchsorted(boundaries, amounts, side="left")
+		exact_idx = numpy.minimum(idx, last)
+		exact = (idx <= last) & (boundaries[exact_idx] == amounts)
+
+		prev = numpy.maximum(idx - 1, 0)
+		result = numpy.asarray(self.base)[prev] + numpy.asarray(self.slope)[prev] * (amounts - boundaries[prev])
+		result = numpy.where(idx > 0, result, 0.0)
+
+		return numpy.where(exact, numpy.asarray(self.at_boundary)[exact_idx], result)
+
+
+def get_tier_schedule(commission_rate):
+	"""Get the compiled tier schedule of a commission rate row, compiling it once"""
+	schedule = getattr(commission_rate, "tier_schedule", None)
+	if schedule is not None:
+		return schedule
+
+	schedule = getattr(commission_rate, "_tier_schedule", None)
+	if schedule is None:
+		schedule = TierSchedule.from_rows(commission_rate.tiered_rates or [])
+		commission_rate._tier_schedule = schedule
+
+	return schedule
+
+
+def apply_commission_limits(commission, minimum_amount=None, maximum_amount=None):
+	"""Clamp a commission to the minimum and maximum amount of a rate row"""
+	if minimum_amount and commission < minimum_amount:
+		commission = minimum_amount
+
+	if maximum_amount and commission > maximum_amount:
+		commission = maximum_amount
+
+	return commission
+
+
+def apply_commission_limits_batch(commissions, minimum_amount=None, maximum_amount=None):
+	"""Clamp an array of commissions exactly like `apply_commission_limits`"""
+	if numpy is None:
+		return [apply_commission_limits(d, minimum_amount, maximum_amount) for d in commissions]
+
+	commissions = numpy.asarray(commissions, dtype=float)
+	if minimum_amount:
+		commissions = numpy.where(commissions < minimum_amount, minimum_amount, commissions)
+
+	if maximum_amount:
+		commissions = numpy.where(commissions > maximum_amount, maximum_amount, commissions)
+
+	return commissions
+
+
+def calculate_tiered_commissions(commission_rate, base_amounts):
+	"""Tiered commission with min/max limits for many base amounts in one call"""
+	commissions = get_tier_schedule(commission_rate).commissions(base_amounts)
+	return apply_commission_limits_batch(
+		commissions, commission_rate.minimum_amount, commission_rate.maximum_amount
+	)
@@ -0,0 +1,129 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""Bulk persistence of Agent Commission Entries.
+
+Entries are validated in memory with the document controller, named from
+the ACE-.YYYY.- series in one reservation and written together with their
+Agent Commission Detail rows and Agent Ledger Entries as multi-row INSERTs,
+all inside the caller's transaction.
+"""
+
+import frappe
+from frappe.model.naming import parse_naming_series
+from frappe.utils import cint, flt, getdate, now_datetime
+
+from sales_agent_commission.agent_ledger import (
+	lock_agent_balances,
+	shift_checkpoints,
+	update_agent_balances,
+)
+
+ENTRY_SERIES = "ACE-.YYYY.-"
+LEDGER_SERIES = "ALE-.YYYY.-"
+SERIES_DIGITS = 5
+
+
+def reserve_names(doctype, series, count, digits=SERIES_DIGITS):
+	"""Reserve a block of names from a naming series.
+
+	The series row is locked for the rest of the transaction, and the block
+	always starts after the highest existing name with the same prefix."""
+	prefix = parse_naming_series(series)
+
+	current = frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE", prefix)
+	if current:
+		start = cint(current[0][0])
+	else:
+		start = 0
+		frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, 0)", prefix)
+
+	last_name = frappe.db.sql(f"""
+		SELECT MAX(name) FROM `tab{doctype}`
+		WHERE name LIKE %s AND LENGTH(name) = %s
+	""", (prefix.replace("%", "\\%") + "%", len(prefix) + digits))[0][0]
+	if last_name:
+		start = max(start, cint(last_name[len(prefix):]))
+
+	frappe.db.sql("UPDATE `tabSeries` SET `current` = %s WHERE `name` = %s", (start + count, prefix))
+
+	return [f"{prefix}{str(start + i).zfill(digits)}" for i in range(1, count + 1)]
+
+
+def set_standard_fields(doc, name, docstatus, now, user):
+	doc.name = name
+	doc.owner = doc.modified_by = user
+	doc.creation = doc.modified = now
+	doc.docstatus = docstatus
+
+
+def bulk_insert_rows(doctype, rows):
+	"""Insert rows of a doctype with multi-row INSERTs"""
+	if not rows:
+		return
+
+	fields = list(rows[0].keys())
+	frappe.db.bulk_insert(doctype, fields, [tuple(row.get(f) for f in fields) for row in rows])
+
+
+def bulk_insert_commission_entries(entries):
+	"""Validate and write submitted Agent Commission Entries with their details
+	and ledger entries in bulk.
+
+	`entries` are unsaved Agent Commission Entry documents, e.g. from
+	`make_commission_entry`. They are updated in place with their names and
+	calculated values."""
+	if not entries:
+		return []
+
+	now = now_datetime()
+	user = frappe.session.user
+
+	agents = {d.agent for d in entries}
+	customers = {d.customer for d in entries if d.customer}
+	agent_names = dict(frappe.get_all("Agent Master",
+		filters={"name": ["in", list(agents)]}, fields=["name", "agent_name"], as_list=1))
+	customer_names = dict(frappe.get_all("Customer",
+		filters={"name": ["in", list(customers)]}, fields=["name", "customer_name"], as_list=1)) if customers else {}
+
+	# Validate everything before anything is named or written
+	for entry in entries:
+		entry.agent_name = agent_names.get(entry.agent)
+		entry.customer_name = customer_names.get(entry.customer)
+		entry._validate_mandatory()
+		entry.run_method("validate")
+
+	entry_names = reserve_names("Agent Commission Entry", ENTRY_SERIES, len(entries))
+	ledger_names = reserve_names("Agent Ledger Entry", LEDGER_SERIES, len(entries))
+	balances = lock_agent_balances(agents)
+
+	entry_rows, detail_rows, ledger_rows = [], [], []
+	for entry, entry_name, ledger_name in zip(entries, entry_names, ledger_names):
+		set_standard_fields(entry, entry_name, 1, now, user)
+		for idx, detail in enumerate(entry.commission_details, 1):
+			set_standard_fields(detail, frappe.generate_hash(length=10), 1, now, user)
+			detail.update({"parent": entry_name, "parenttype": entry.doctype,
+				"parentfield": "commission_details", "idx": idx})
+			detail_rows.append(detail.get_valid_dict(convert_dates_to_str=True))
+
+		entry_rows.append(entry.get_valid_dict(convert_dates_to_str=True))
+
+		balances[entry.agent] = flt(balances.get(entry.agent)) + flt(entry.commission_amount)
+		ledger_entry = entry.make_ledger_entry(balances[entry.agent])
+		ledger_entry.agent_name = entry.agent_name
+		# Commission ledger entries are saved, not submitted, like the document path
+		set_standard_fields(ledger_entry, ledger_name, 0, now, user)
+		ledger_rows.append(ledger_entry.get_valid_dict(convert_dates_to_str=True))
+
+	bulk_insert_rows("Agent Commission Entry", entry_rows)
+	bulk_insert_rows("Agent Commission Detail", detail_rows)
+	bulk_insert_rows("Agent Ledger Entry", ledger_rows)
+	update_agent_balances(balances)
+
+	checkpoint_amounts = {}
+	for entry in entries:
+		key = (entry.agent, getdate(entry.posting_date))
+		checkpoint_amounts[key] = checkpoint_amounts.get(key, 0) + flt(entry.commission_amount)
+	shift_checkpoints(checkpoint_amounts)
+
+	return entry_names
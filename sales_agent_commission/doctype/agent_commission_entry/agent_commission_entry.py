@@ -5,8 +5,12 @@
 from __future__ import unicode_literals
 import frappe
 from frappe.model.document import Document
-from frappe.utils import flt, getdate, nowdate
+from frappe.utils import cint, flt, getdate, nowdate
 from frappe import _
+from sales_agent_commission.agent_ledger import (cancel_ledger_entries, get_current_balance, lock_agent_balances,
+    post_to_agent_balance)
+from sales_agent_commission.charge_classifier import get_invoice_charges
+from sales_agent_commission.commission_calculator import InvoiceLine, calculate_group_commissions, group_line_amounts
 
 class AgentCommissionEntry(Document):
     def validate(self):
@@ -33,7 +37,13 @@ class AgentCommissionEntry(Document):
         
     def create_ledger_entry(self):
         """Create entry in Agent Ledger"""
-        ledger_entry = frappe.get_doc({
+        ledger_entry = self.make_ledger_entry(
+            post_to_agent_balance(self.agent, self.commission_amount, self.posting_date))
+        ledger_entry.insert()
+        
+    def make_ledger_entry(self, balance):
+        """Build the Agent Ledger entry of this commission"""
+        return frappe.get_doc({
             "doctype": "Agent Ledger Entry",
             "agent": self.agent,
             "posting_date": self.posting_date,
@@ -43,137 +53,166 @@ class AgentCommissionEntry(Document):
             "sales_invoice": self.sales_invoice,
             "debit": self.commission_amount,
             "credit": 0,
-            "balance": self.get_running_balance() + self.commission_amount,
+            "balance": balance,
             "remarks": f"Commission for Invoice {self.sales_invoice}"
         })
-        ledger_entry.insert()
         
     def get_running_balance(self):
         """Get running balance for agent"""
-        last_entry = frappe.db.sql("""
-            SELECT balance 
-            FROM `tabAgent Ledger Entry` 
-            WHERE agent = %s 
-            ORDER BY creation DESC 
-            LIMIT 1
-        """, self.agent)
-        
-        return flt(last_entry[0][0]) if last_entry else 0
+        return get_current_balance(self.agent)
     
     def on_cancel(self):
         """Cancel related ledger entries"""
-        frappe.db.sql("""
-            UPDATE `tabAgent Ledger Entry`
-            SET docstatus = 2
-            WHERE reference_type = 'Agent Commission Entry'
-            AND reference_name = %s
-        """, self.name)
+        cancel_ledger_entries("Agent Commission Entry", self.name)
 
 @frappe.whitelist()
-def create_commission_from_invoice(sales_invoice):
-    """Create commission entry from Sales Invoice"""
+def create_commission_from_invoice(sales_invoice, bulk=False):
+    """Create commission entry from Sales Invoice.
+
+    With `bulk` the entries are written through the multi-row writer instead
+    of being inserted and submitted one by one."""
     invoice = frappe.get_doc("Sales Invoice", sales_invoice)
+    commission_entries = make_commission_entries(invoice)
+    
+    # Entries of the invoice this one amends are linked as their amendments
+    amended_entries = get_amended_entries(invoice)
+    for commission_entry in commission_entries:
+        commission_entry.amended_from = amended_entries.get(commission_entry.agent)
+    
+    if cint(bulk):
+        from sales_agent_commission.commission_writer import bulk_insert_commission_entries
+        return bulk_insert_commission_entries(commission_entries)
+    
+    # Each submit posts to its agent's balance, so all of them are locked
+    # first, in name order, for concurrent invoices sharing agents
+    lock_agent_balances([d.agent for d in commission_entries])
+    for commission_entry in commission_entries:
+        commission_entry.insert()
+        commission_entry.submit()
     
+    return [d.name for d in commission_entries]
+
+def make_commission_entries(invoice):
+    """Build unsaved commission entries for every applicable agent on an invoice"""
     # Get applicable agents
     agents = get_applicable_agents(invoice)
     
+    # Item group totals and charges are shared by all agents on the invoice
+    item_group_totals = get_item_group_totals(invoice)
+    freight_charges, logistics_charges = get_invoice_charges(invoice)
+    
     commission_entries = []
     for agent in agents:
         # Calculate commission for each item group
-        commission_details = calculate_commission_details(invoice, agent)
+        commission_details = calculate_commission_details(invoice, agent, item_group_totals)
         
         if commission_details:
-            commission_entry = frappe.get_doc({
-                "doctype": "Agent Commission Entry",
-                "agent": agent,
-                "sales_invoice": sales_invoice,
-                "customer": invoice.customer,
-                "territory": invoice.territory,
-                "posting_date": invoice.posting_date,
-                "invoice_amount": invoice.grand_total,
-                "freight_charges": get_freight_charges(invoice),
-                "logistics_charges": get_logistics_charges(invoice),
-                "currency": invoice.currency,
-                "commission_details": commission_details
-            })
-            commission_entry.insert()
-            commission_entry.submit()
-            commission_entries.append(commission_entry.name)
+            commission_entries.append(make_commission_entry(invoice, agent, commission_details,
+                freight_charges, logistics_charges))
     
     return commission_entries
 
+def make_commission_entry(invoice, agent, commission_details, freight_charges, logistics_charges):
+    """Build an unsaved Agent Commission Entry for an agent on an invoice"""
+    return frappe.get_doc({
+        "doctype": "Agent Commission Entry",
+        "agent": agent,
+        "sales_invoice": invoice.name,
+        "customer": invoice.customer,
+        "territory": invoice.territory,
+        "posting_date": invoice.posting_date,
+        "invoice_amount": invoice.grand_total,
+        "invoice_outstanding_amount": invoice.get("outstanding_amount"),
+        "freight_charges": freight_charges,
+        "logistics_charges": logistics_charges,
+        "currency": invoice.currency,
+        "commission_details": commission_details
+    })
+
+def get_amended_entries(invoice):
+    """Get the cancelled commission entries of the amended invoice by agent.
+
+    They stay cancelled on the original invoice, so its commission history and
+    ledger are kept, and each new entry of the amendment links back to the
+    prior entry of its agent.
+
+    Every agent still gets a new entry and Commission ledger row, even when
+    its commission is unchanged. The prior entries and their ledger rows were
+    already cancelled and reversed with the original invoice, and posting only
+    the difference would mean reviving them."""
+    if not invoice.get("amended_from"):
+        return {}
+    
+    entries = {}
+    for entry in frappe.get_all("Agent Commission Entry",
+        filters={"sales_invoice": invoice.amended_from, "docstatus": 2},
+        fields=["name", "agent"],
+        order_by="creation desc"):
+        entries.setdefault(entry.agent, entry.name)
+    
+    return entries
+
 def get_applicable_agents(invoice):
     """Get agents applicable for the invoice based on territory/customer"""
-    agents = []
-    
-    # Check customer-specific agents
-    customer_agents = frappe.db.sql("""
-        SELECT DISTINCT am.name
-        FROM `tabAgent Master` am
-        INNER JOIN `tabAgent Customer Assignment` aca ON aca.parent = am.name
-        WHERE aca.customer = %s
-        AND am.status = 'Active'
-        AND am.docstatus = 1
-    """, invoice.customer, as_dict=1)
-    
-    # Check territory-specific agents
-    if invoice.territory:
-        territory_agents = frappe.db.sql("""
-            SELECT DISTINCT am.name
-            FROM `tabAgent Master` am
-            INNER JOIN `tabAgent Territory Assignment` ata ON ata.parent = am.name
-            WHERE ata.territory = %s
-            AND am.status = 'Active'
-            AND am.docstatus = 1
-        """, invoice.territory, as_dict=1)
-        
-        agents.extend([a.name for a in territory_agents])
+    from sales_agent_commission.agent_resolver import get_applicable_agents as resolve_applicable_agents
+    
+    return resolve_applicable_agents(invoice)
+
+def get_item_group_totals(invoice):
+    """Get invoice amount grouped by item group.
+
+    The item group is taken from the invoice line where available; the
+    remaining items are resolved with a single query."""
+    missing = {item.item_code for item in invoice.items if not item.get("item_group")}
+    item_groups = {}
+    if missing:
+        item_groups = dict(frappe.get_all("Item",
+            filters={"name": ["in", list(missing)]},
+            fields=["name", "item_group"],
+            as_list=1))
     
-    agents.extend([a.name for a in customer_agents])
-    return list(set(agents))  # Remove duplicates
+    lines = [InvoiceLine.from_row(item, item_groups.get(item.item_code)) for item in invoice.items]
+    return group_line_amounts(lines)
 
-def calculate_commission_details(invoice, agent):
+def calculate_commission_details(invoice, agent, item_group_totals=None):
     """Calculate commission details for each item group"""
-    from sales_agent_commission.doctype.agent_master.agent_master import get_agent_commission_rate
-    
-    item_group_totals = {}
-    
-    # Group items by item group
-    for item in invoice.items:
-        item_group = frappe.db.get_value("Item", item.item_code, "item_group")
-        if item_group not in item_group_totals:
-            item_group_totals[item_group] = 0
-        item_group_totals[item_group] += item.amount
-    
-    # Calculate commission for each item group
-    commission_details = []
-    for item_group, amount in item_group_totals.items():
-        rate = get_agent_commission_rate(agent, item_group, invoice.customer, invoice.territory)
-        if rate > 0:
-            commission_details.append({
-                "item_group": item_group,
-                "amount": amount,
-                "commission_rate": rate,
-                "commission_amount": flt(amount * rate / 100)
-            })
-    
-    return commission_details
+    from sales_agent_commission.agent_resolver import get_invoice_territories
+    from sales_agent_commission.doctype.agent_master.agent_master import get_agent_rate_index
+    
+    if item_group_totals is None:
+        item_group_totals = get_item_group_totals(invoice)
+    
+    rows = calculate_group_commissions(item_group_totals, get_agent_rate_index(agent),
+        invoice.customer, get_invoice_territories(invoice))
+    
+    return [row.as_detail() for row in rows]
 
 def get_freight_charges(invoice):
     """Extract freight charges from invoice"""
-    freight = 0
-    for tax in invoice.taxes:
-        if "freight" in tax.description.lower() or "shipping" in tax.description.lower():
-            freight += tax.tax_amount
-    return freight
+    return get_invoice_charges(invoice)[0]
 
 def get_logistics_charges(invoice):
     """Extract logistics charges from invoice"""
-    logistics = 0
-    for tax in invoice.taxes:
-        if "logistics" in tax.description.lower() or "handling" in tax.description.lower():
-            logistics += tax.tax_amount
-    return logistics
+    return get_invoice_charges(invoice)[1]
+
+def update_invoice_snapshot(sales_invoice):
+    """Refresh the invoice outstanding amount captured on commission entries
+    from the Payment Ledger. Returns the outstanding amount, or None when the
+    invoice has no ledger entries and the snapshot is kept."""
+    from sales_agent_commission.utils import get_outstanding_amounts
+    
+    outstanding_amount = get_outstanding_amounts([sales_invoice]).get(sales_invoice)
+    if outstanding_amount is None:
+        return None
+    
+    frappe.db.sql("""
+        UPDATE `tabAgent Commission Entry`
+        SET invoice_outstanding_amount = %s
+        WHERE sales_invoice = %s
+        AND docstatus = 1
+    """, (outstanding_amount, sales_invoice))
+    
+    return outstanding_amount
 
 @frappe.whitelist()
 def update_payment_status(sales_invoice):
@@ -185,4 +224,8 @@ def update_payment_status(sales_invoice):
         AND docstatus = 1
     """, sales_invoice)
     
-    frappe.db.commit()
\ No newline at end of file
+    frappe.db.commit()
+
+def on_doctype_update():
+    # Due entries of an agent are paged by (posting_date, name)
+    frappe.db.add_index("Agent Commission Entry", ["agent", "status", "posting_date"])
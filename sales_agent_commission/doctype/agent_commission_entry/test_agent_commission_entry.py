@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from sales_agent_commission.agent_ledger import get_current_balance, get_ledger_balances
+from sales_agent_commission.agent_resolver import clear_assignment_map
+
+TEST_AGENT = "_Test Commission Agent"
+
+class TestAgentCommissionEntry(FrappeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        frappe.db.set_single_value("Agent Commission Settings", "create_commissions_in_background", 0)
+        make_test_agent()
+
+    def test_amended_invoice_links_prior_commission(self):
+        invoice = create_sales_invoice(qty=1, rate=1000)
+        prior_entry = get_active_entry(invoice.name)
+        self.assertTrue(prior_entry)
+        self.assertEqual(get_commission_details(prior_entry), [("_Test Item Group", 1000, 10, 100)])
+
+        invoice.cancel()
+        self.assertEqual(frappe.db.get_value("Agent Commission Entry", prior_entry, "docstatus"), 2)
+
+        amendment = frappe.copy_doc(invoice)
+        amendment.docstatus = 0
+        amendment.amended_from = invoice.name
+        amendment.items[0].rate = 2000
+        amendment.insert()
+        # The submit hook creates the entries through create_commission_from_invoice
+        amendment.submit()
+
+        entry = get_active_entry(amendment.name)
+        self.assertEqual(frappe.db.get_value("Agent Commission Entry", entry, "amended_from"), prior_entry)
+        self.assertEqual(get_commission_details(entry), [("_Test Item Group", 2000, 10, 200)])
+
+        # The prior entry keeps its cancelled record on the original invoice
+        self.assertEqual(frappe.db.get_value("Agent Commission Entry", prior_entry,
+            ["docstatus", "sales_invoice"]), (2, invoice.name))
+
+        # The agent balance matches the active ledger and the active commission
+        active_commission = sum(frappe.get_all("Agent Commission Entry",
+            filters={"agent": TEST_AGENT, "docstatus": 1}, pluck="commission_amount"))
+        self.assertEqual(flt(get_current_balance(TEST_AGENT), 2), flt(active_commission, 2))
+        self.assertEqual(flt(get_ledger_balances([TEST_AGENT]).get(TEST_AGENT), 2), flt(active_commission, 2))
+
+def get_active_entry(sales_invoice):
+    return frappe.db.get_value("Agent Commission Entry",
+        {"sales_invoice": sales_invoice, "agent": TEST_AGENT, "docstatus": 1})
+
+def get_commission_details(entry):
+    return [
+        (d.item_group, flt(d.amount), flt(d.commission_rate), flt(d.commission_amount))
+        for d in frappe.get_all("Agent Commission Detail",
+            filters={"parent": entry, "parenttype": "Agent Commission Entry"},
+            fields=["item_group", "amount", "commission_rate", "commission_amount"],
+            order_by="idx")
+    ]
+
+def make_test_agent():
+    if not frappe.db.exists("Agent Master", TEST_AGENT):
+        insert_test_agent()
+
+    # Agent Master is not submittable, but agents are only resolved once
+    # they are marked submitted
+    frappe.db.set_value("Agent Master", TEST_AGENT, "docstatus", 1)
+    clear_assignment_map()
+
+def insert_test_agent():
+    frappe.get_doc({
+        "doctype": "Agent Master",
+        "agent_code": TEST_AGENT,
+        "agent_name": TEST_AGENT,
+        "status": "Active",
+        "agent_type": "Individual",
+        "contact_person": "Test Contact",
+        "email": "commission_agent@example.com",
+        "mobile_no": "9999999999",
+        "agreement_date": "2024-01-01",
+        "commission_rates": [{
+            "item_group": "_Test Item Group",
+            "commission_percent": 10,
+            "applicable_for": "All"
+        }],
+        "customer_assignments": [{"customer": "_Test Customer"}],
+        "bank_accounts": [{
+            "bank_name": "_Test Bank",
+            "account_name": TEST_AGENT,
+            "account_number": "000111222",
+            "is_primary": 1
+        }]
+    }).insert()
@@ -5,8 +5,11 @@
 from __future__ import unicode_literals
 import frappe
 from frappe.model.document import Document
-from frappe.utils import flt, getdate, nowdate
+from frappe.utils import cint, flt, getdate, nowdate, now_datetime
 from frappe import _
+from sales_agent_commission.agent_ledger import cancel_ledger_entries, get_current_balance, post_to_agent_balance
+
+DEFAULT_PAGE_LENGTH = 500
 
 class AgentCommissionPayment(Document):
     def validate(self):
@@ -16,14 +19,40 @@ class AgentCommissionPayment(Document):
         
     def validate_commission_entries(self):
         """Ensure all commission entries are due for payment"""
+        commission_entries = {
+            d.name: d for d in frappe.get_all("Agent Commission Entry",
+                filters={"name": ["in", self.get_commission_entry_names()]},
+                fields=["name", "status", "is_paid"])
+        }
+        
         for entry in self.commission_entries:
-            commission_entry = frappe.get_doc("Agent Commission Entry", entry.commission_entry)
+            commission_entry = commission_entries.get(entry.commission_entry)
+            if not commission_entry:
+                frappe.throw(_("Commission Entry {0} not found").format(entry.commission_entry),
+                    frappe.DoesNotExistError)
             if commission_entry.status != "Due":
                 frappe.throw(_("Commission Entry {0} is not due for payment. Status: {1}").format(
                     entry.commission_entry, commission_entry.status))
             if commission_entry.is_paid:
                 frappe.throw(_("Commission Entry {0} is already paid").format(entry.commission_entry))
     
+    def get_commission_entry_names(self):
+        return list({d.commission_entry for d in self.commission_entries if d.commission_entry})
+    
+    def lock_commission_entries(self):
+        """Lock the referenced commission entries for the rest of the transaction"""
+        names = self.get_commission_entry_names()
+        if not names:
+            return []
+        
+        return frappe.db.sql("""
+            SELECT name, status, is_paid, payment_reference
+            FROM `tabAgent Commission Entry`
+            WHERE name IN %(names)s
+            ORDER BY name
+            FOR UPDATE
+        """, {"names": tuple(names)}, as_dict=1)
+    
     def calculate_totals(self):
         """Calculate total payment amount"""
         self.total_amount = sum(flt(entry.commission_amount) for entry in self.commission_entries)
@@ -53,12 +82,24 @@ class AgentCommissionPayment(Document):
         
     def mark_entries_as_paid(self):
         """Mark all commission entries as paid"""
-        for entry in self.commission_entries:
-            frappe.db.set_value("Agent Commission Entry", entry.commission_entry, {
-                "is_paid": 1,
-                "payment_reference": self.name,
+        # Checked again under the lock, so two payments cannot claim the same entry
+        locked = self.lock_commission_entries()
+        claimed = [d.name for d in locked if d.is_paid or d.status != "Due"]
+        if claimed:
+            frappe.throw(_("Commission Entries {0} are no longer due for payment").format(", ".join(claimed)))
+        
+        if locked:
+            frappe.db.sql("""
+                UPDATE `tabAgent Commission Entry`
+                SET is_paid = 1, payment_reference = %(payment)s, payment_date = %(payment_date)s,
+                    status = 'Paid', modified = %(modified)s, modified_by = %(user)s
+                WHERE name IN %(names)s
+            """, {
+                "payment": self.name,
                 "payment_date": self.payment_date,
-                "status": "Paid"
+                "modified": now_datetime(),
+                "user": frappe.session.user,
+                "names": tuple(d.name for d in locked)
             })
     
     def create_payment_ledger_entry(self):
@@ -72,7 +113,7 @@ class AgentCommissionPayment(Document):
             "reference_name": self.name,
             "debit": 0,
             "credit": self.total_amount,
-            "balance": self.get_running_balance() - self.total_amount,
+            "balance": post_to_agent_balance(self.agent, -flt(self.total_amount), self.payment_date),
             "remarks": f"Payment for {len(self.commission_entries)} commission entries"
         })
         ledger_entry.insert()
@@ -80,16 +121,7 @@ class AgentCommissionPayment(Document):
         
     def get_running_balance(self):
         """Get running balance for agent"""
-        last_entry = frappe.db.sql("""
-            SELECT balance 
-            FROM `tabAgent Ledger Entry` 
-            WHERE agent = %s 
-            AND docstatus = 1
-            ORDER BY creation DESC 
-            LIMIT 1
-        """, self.agent)
-        
-        return flt(last_entry[0][0]) if last_entry else 0
+        return get_current_balance(self.agent)
     
     def create_payment_entry(self):
         """Create actual payment entry in accounts"""
@@ -112,26 +144,32 @@ class AgentCommissionPayment(Document):
     
     def on_cancel(self):
         """Reverse payment entries"""
-        # Mark commission entries as unpaid
-        for entry in self.commission_entries:
-            frappe.db.set_value("Agent Commission Entry", entry.commission_entry, {
-                "is_paid": 0,
-                "payment_reference": None,
-                "payment_date": None,
-                "status": "Due"
+        # Mark commission entries as unpaid, leaving entries paid by another payment alone
+        paid_here = [d.name for d in self.lock_commission_entries() if d.payment_reference == self.name]
+        if paid_here:
+            frappe.db.sql("""
+                UPDATE `tabAgent Commission Entry`
+                SET is_paid = 0, payment_reference = NULL, payment_date = NULL,
+                    status = 'Due', modified = %(modified)s, modified_by = %(user)s
+                WHERE name IN %(names)s
+            """, {
+                "modified": now_datetime(),
+                "user": frappe.session.user,
+                "names": tuple(paid_here)
             })
         
         # Cancel ledger entries
-        frappe.db.sql("""
-            UPDATE `tabAgent Ledger Entry`
-            SET docstatus = 2
-            WHERE reference_type = 'Agent Commission Payment'
-            AND reference_name = %s
-        """, self.name)
+        cancel_ledger_entries("Agent Commission Payment", self.name)
 
 @frappe.whitelist()
-def get_due_commission_entries(agent, from_date=None, to_date=None):
-    """Get all due commission entries for an agent"""
+def get_due_commission_entries(agent, from_date=None, to_date=None, last_posting_date=None, last_name=None,
+    page_length=None, aggregate_only=False):
+    """Get due commission entries for an agent, ordered by posting date and name.
+
+    Entries are paged when a `page_length` or a cursor is given: pass the
+    posting date and name of the last entry of a page to get the next page.
+    Without either, all due entries are returned. With `aggregate_only`, only
+    the count and total commission of all due entries are returned."""
     conditions = ["agent = %(agent)s", "status = 'Due'", "docstatus = 1", "is_paid = 0"]
     
     if from_date:
@@ -139,6 +177,31 @@ def get_due_commission_entries(agent, from_date=None, to_date=None):
     if to_date:
         conditions.append("posting_date <= %(to_date)s")
     
+    values = {
+        "agent": agent,
+        "from_date": from_date,
+        "to_date": to_date,
+        "last_posting_date": last_posting_date,
+        "last_name": last_name,
+        "page_length": cint(page_length) or DEFAULT_PAGE_LENGTH
+    }
+    paged = bool(cint(page_length) or last_name)
+    
+    if cint(aggregate_only):
+        return frappe.db.sql("""
+            SELECT COUNT(*) AS count, IFNULL(SUM(commission_amount), 0) AS total_amount
+            FROM `tabAgent Commission Entry`
+            WHERE {0}
+        """.format(" AND ".join(conditions)), values, as_dict=1)[0]
+    
+    if last_name:
+        if last_posting_date:
+            conditions.append("""(posting_date > %(last_posting_date)s
+                OR (posting_date = %(last_posting_date)s AND name > %(last_name)s))""")
+        else:
+            # Entries without a posting date sort first
+            conditions.append("(posting_date IS NOT NULL OR name > %(last_name)s)")
+    
     entries = frappe.db.sql("""
         SELECT 
             name,
@@ -148,11 +211,8 @@ def get_due_commission_entries(agent, from_date=None, to_date=None):
             currency
         FROM `tabAgent Commission Entry`
         WHERE {0}
-        ORDER BY posting_date
-    """.format(" AND ".join(conditions)), {
-        "agent": agent,
-        "from_date": from_date,
-        "to_date": to_date
-    }, as_dict=1)
+        ORDER BY posting_date, name
+        {1}
+    """.format(" AND ".join(conditions), "LIMIT %(page_length)s" if paged else ""), values, as_dict=1)
     
-    return entries
\ No newline at end of file
+    return entries
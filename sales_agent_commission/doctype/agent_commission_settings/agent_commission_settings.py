@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+from frappe.model.document import Document
+from sales_agent_commission.charge_classifier import clear_charge_classifier
+
+class AgentCommissionSettings(Document):
+    def on_update(self):
+        """Recompile the charge classifier with the new mappings"""
+        clear_charge_classifier()
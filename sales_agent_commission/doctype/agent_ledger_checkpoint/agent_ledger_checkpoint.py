@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class AgentLedgerCheckpoint(Document):
+    pass
+
+def on_doctype_update():
+    frappe.db.add_index("Agent Ledger Checkpoint", ["agent", "checkpoint_date"])
@@ -7,6 +7,8 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import getdate, nowdate, flt
 from frappe import _
+from sales_agent_commission.agent_resolver import refresh_agent_assignments, remove_agent_assignments
+from sales_agent_commission.commission_calculator import resolve_commission_rate
 
 class AgentMaster(Document):
     def validate(self):
@@ -47,10 +49,29 @@ class AgentMaster(Document):
         count = frappe.db.count("Agent Master") + 1
         return f"{prefix}{str(count).zfill(5)}"
     
+    def on_update(self):
+        """Drop the compiled rate index so the next lookup rebuilds it"""
+        clear_agent_rate_index(self.name)
+        refresh_agent_assignments(self)
+
     def on_submit(self):
         """Create ledger account for agent"""
+        clear_agent_rate_index(self.name)
+        refresh_agent_assignments(self)
         self.create_agent_ledger_account()
         frappe.msgprint(_("Agent {0} onboarded successfully").format(self.agent_name))
+
+    def on_update_after_submit(self):
+        clear_agent_rate_index(self.name)
+        refresh_agent_assignments(self)
+
+    def on_cancel(self):
+        clear_agent_rate_index(self.name)
+        refresh_agent_assignments(self)
+
+    def on_trash(self):
+        clear_agent_rate_index(self.name)
+        remove_agent_assignments(self.name)
     
     def create_agent_ledger_account(self):
         """Create a ledger account for commission tracking"""
@@ -72,30 +93,47 @@ class AgentMaster(Document):
                 account.insert()
                 self.db_set("ledger_account", account.name)
 
+RATE_INDEX_CACHE_KEY = "agent_commission_rate_index"
+
+def build_agent_rate_index(agent_doc):
+    """Compile the commission rates of an Agent Master into a lookup keyed by
+    (item_group, applicable_for, customer/territory).
+
+    Customer and Territory rates are only compiled when the customer or
+    territory is actually assigned to the agent, and the first matching row
+    wins, mirroring the order in which rates were previously scanned."""
+    customers = {d.customer for d in agent_doc.customer_assignments}
+    territories = {d.territory for d in agent_doc.territories}
+
+    index = {}
+    for rate in agent_doc.commission_rates:
+        if rate.applicable_for == "Customer":
+            if rate.customer not in customers:
+                continue
+            key = (rate.item_group, "Customer", rate.customer)
+        elif rate.applicable_for == "Territory":
+            if rate.territory not in territories:
+                continue
+            key = (rate.item_group, "Territory", rate.territory)
+        elif rate.applicable_for == "All":
+            key = (rate.item_group, "All", None)
+        else:
+            continue
+
+        index.setdefault(key, flt(rate.commission_percent))
+
+    return index
+
+def get_agent_rate_index(agent):
+    """Get the compiled rate index for an agent, building it on first use"""
+    return frappe.cache().hget(RATE_INDEX_CACHE_KEY, agent,
+        lambda: build_agent_rate_index(frappe.get_doc("Agent Master", agent)))
+
+def clear_agent_rate_index(agent):
+    """Invalidate the compiled rate index of an agent"""
+    frappe.cache().hdel(RATE_INDEX_CACHE_KEY, agent)
+
 @frappe.whitelist()
 def get_agent_commission_rate(agent, item_group, customer=None, territory=None):
     """Get applicable commission rate for agent"""
-    agent_doc = frappe.get_doc("Agent Master", agent)
-    
-    # Check customer-specific rates first
-    if customer:
-        for assignment in agent_doc.customer_assignments:
-            if assignment.customer == customer:
-                for rate in agent_doc.commission_rates:
-                    if rate.item_group == item_group and rate.applicable_for == "Customer" and rate.customer == customer:
-                        return flt(rate.commission_percent)
-    
-    # Check territory-specific rates
-    if territory:
-        for terr in agent_doc.territories:
-            if terr.territory == territory:
-                for rate in agent_doc.commission_rates:
-                    if rate.item_group == item_group and rate.applicable_for == "Territory" and rate.territory == territory:
-                        return flt(rate.commission_percent)
-    
-    # Return default rate for item group
-    for rate in agent_doc.commission_rates:
-        if rate.item_group == item_group and rate.applicable_for == "All":
-            return flt(rate.commission_percent)
-    
-    return 0
\ No newline at end of file
+    return resolve_commission_rate(get_agent_rate_index(agent), item_group, customer, territory)
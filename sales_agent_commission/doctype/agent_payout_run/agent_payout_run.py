@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024, Sales Agent Commission and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cint, flt, getdate
+from frappe.utils.background_jobs import is_job_enqueued
+
+PAYOUT_JOBS_KEY = "agent_payout_run_jobs"
+DEFAULT_CHUNK_SIZE = 50
+
+class AgentPayoutRun(Document):
+    def validate(self):
+        if self.from_date and getdate(self.from_date) > getdate(self.cut_off_date):
+            frappe.throw(_("From Date cannot be after Cut-off Date"))
+
+        self.calculate_totals()
+
+    def calculate_totals(self):
+        self.total_agents = len(self.agents)
+        self.total_amount = sum(flt(d.amount) for d in self.agents)
+
+    def get_filters(self):
+        return frappe._dict({
+            "company": self.company,
+            "cut_off_date": self.cut_off_date,
+            "from_date": self.from_date,
+            "agent": self.agent,
+            "agent_type": self.agent_type,
+            "minimum_amount": self.minimum_amount
+        })
+
+    @frappe.whitelist()
+    def get_due_agents(self):
+        """Fill the agents table with the due commission of every agent, from one grouped query"""
+        if any(d.payment for d in self.agents):
+            frappe.throw(_("Agents cannot be fetched again once payments have been created"))
+
+        self.set("agents", [])
+        for row in get_due_commission_summary(self.get_filters()):
+            self.append("agents", row)
+
+        self.save()
+
+    @frappe.whitelist()
+    def create_payments(self):
+        """Create the payments of all pending and failed agents in parallel background jobs.
+        Agents whose payment was already created are skipped, so a failed run resumes
+        where it stopped."""
+        frappe.has_permission("Agent Commission Payment", "create", throw=True)
+
+        if is_payout_run_running(self.name):
+            frappe.throw(_("Payout Run {0} is already running").format(self.name))
+
+        return enqueue_payout_run(self)
+
+    @frappe.whitelist()
+    def export_bank_file(self, file_format=None, max_batch_size=None):
+        """Write the submitted payments of the run to bank files attached to it"""
+        from sales_agent_commission.bank_file import export_bank_files
+
+        frappe.has_permission("Agent Payout Run", "write", self.name, throw=True)
+
+        return export_bank_files(self.name, file_format, max_batch_size)
+
+def get_due_entry_conditions(filters):
+    """Conditions on due commission entries of a company up to the cut-off date.
+    Agent Commission Entry has no company, so it is taken from the Sales Invoice."""
+    conditions = [
+        "ace.docstatus = 1",
+        "ace.status = 'Due'",
+        "ace.is_paid = 0",
+        "si.company = %(company)s",
+        "ace.posting_date <= %(cut_off_date)s"
+    ]
+
+    if filters.from_date:
+        conditions.append("ace.posting_date >= %(from_date)s")
+    if filters.agent:
+        conditions.append("ace.agent = %(agent)s")
+    if filters.agent_type:
+        conditions.append("agent.agent_type = %(agent_type)s")
+
+    return " AND ".join(conditions)
+
+def get_due_commission_summary(filters):
+    """Get the due entries and commission of every agent and currency in one query"""
+    having = ""
+    if flt(filters.minimum_amount):
+        having = "HAVING SUM(ace.commission_amount) >= %(minimum_amount)s"
+
+    return frappe.db.sql("""
+        SELECT ace.agent, agent.agent_name, ace.currency,
+            COUNT(*) AS entries, SUM(ace.commission_amount) AS amount
+        FROM `tabAgent Commission Entry` ace
+        INNER JOIN `tabSales Invoice` si ON si.name = ace.sales_invoice
+        INNER JOIN `tabAgent Master` agent ON agent.name = ace.agent
+        WHERE {conditions}
+        GROUP BY ace.agent, agent.agent_name, ace.currency
+        {having}
+        ORDER BY ace.agent, ace.currency
+    """.format(conditions=get_due_entry_conditions(filters), having=having), filters, as_dict=1)
+
+def get_due_entries_by_agent(filters, agents):
+    """Get the due entries of many agents in one query, grouped by (agent, currency)"""
+    if not agents:
+        return {}
+
+    entries = frappe.db.sql("""
+        SELECT ace.name, ace.agent, ace.currency, ace.sales_invoice, ace.posting_date,
+            ace.commission_amount, ace.invoice_payment_date
+        FROM `tabAgent Commission Entry` ace
+        INNER JOIN `tabSales Invoice` si ON si.name = ace.sales_invoice
+        INNER JOIN `tabAgent Master` agent ON agent.name = ace.agent
+        WHERE {conditions}
+        AND ace.agent IN %(agents)s
+        ORDER BY ace.agent, ace.posting_date, ace.name
+    """.format(conditions=get_due_entry_conditions(filters)), dict(filters, agents=tuple(agents)), as_dict=1)
+
+    entries_by_agent = {}
+    for entry in entries:
+        entries_by_agent.setdefault((entry.agent, entry.currency), []).append(entry)
+
+    return entries_by_agent
+
+def get_payout_job_id(run, chunk):
+    return f"agent_payout_run::{run}::{chunk}"
+
+def is_payout_run_running(run):
+    chunks = cint(frappe.cache().hget(PAYOUT_JOBS_KEY, run))
+    return any(is_job_enqueued(get_payout_job_id(run, chunk)) for chunk in range(chunks))
+
+def enqueue_payout_run(run_doc):
+    """Split the agents still to be paid into chunks, one background job each"""
+    rows = [d.name for d in run_doc.agents if d.status in ("Pending", "Failed")]
+    if not rows:
+        frappe.throw(_("There are no agents left to pay in Payout Run {0}").format(run_doc.name))
+
+    # Failed agents are retried
+    frappe.db.sql("""
+        UPDATE `tabAgent Payout Run Item`
+        SET status = 'Pending', error = NULL
+        WHERE parent = %s
+        AND parenttype = 'Agent Payout Run'
+        AND status = 'Failed'
+    """, run_doc.name)
+
+    chunk_size = cint(run_doc.chunk_size) or DEFAULT_CHUNK_SIZE
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+    frappe.cache().hset(PAYOUT_JOBS_KEY, run_doc.name, len(chunks))
+    run_doc.db_set("status", "Queued")
+
+    for chunk, chunk_rows in enumerate(chunks):
+        frappe.enqueue(
+            process_payout_chunk,
+            queue="long",
+            job_id=get_payout_job_id(run_doc.name, chunk),
+            deduplicate=True,
+            enqueue_after_commit=True,
+            run=run_doc.name,
+            rows=chunk_rows
+        )
+
+    return len(chunks)
+
+def process_payout_chunk(run, rows):
+    """Background job creating the payments of a chunk of agents.
+
+    Each payment is committed together with its agent's status, which is the
+    checkpoint a resumed run starts from."""
+    run_doc = frappe.get_doc("Agent Payout Run", run)
+    if run_doc.status == "Queued":
+        frappe.db.set_value("Agent Payout Run", run, "status", "In Progress", update_modified=False)
+        frappe.db.commit()
+
+    rows = set(rows)
+    items = [d for d in run_doc.agents if d.name in rows and d.status == "Pending"]
+    entries = get_due_entries_by_agent(run_doc.get_filters(), {d.agent for d in items})
+
+    for item in items:
+        try:
+            agent_entries = entries.get((item.agent, item.currency))
+            if agent_entries:
+                values = {"status": "Created", "payment": make_agent_payment(run_doc, item, agent_entries)}
+            else:
+                values = {"status": "Skipped", "error": _("No due commission entries left")}
+
+            frappe.db.set_value("Agent Payout Run Item", item.name, values, update_modified=False)
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(title=f"Payout Run {run} failed for agent {item.agent}")
+            frappe.db.set_value("Agent Payout Run Item", item.name, {
+                "status": "Failed",
+                "error": frappe.get_traceback().strip().splitlines()[-1]
+            }, update_modified=False)
+            frappe.db.commit()
+
+        update_payout_progress(run)
+
+def make_agent_payment(run_doc, item, entries):
+    payment = frappe.get_doc({
+        "doctype": "Agent Commission Payment",
+        "agent": item.agent,
+        "payment_date": run_doc.payment_date,
+        "payment_mode": run_doc.payment_mode,
+        "create_payment_entry_flag": run_doc.create_payment_entry_flag,
+        "from_date": run_doc.from_date,
+        "to_date": run_doc.cut_off_date,
+        "currency": item.currency,
+        "remarks": _("Payout Run {0}").format(run_doc.name),
+        "commission_entries": [
+            {
+                "commission_entry": entry.name,
+                "sales_invoice": entry.sales_invoice,
+                "posting_date": entry.posting_date,
+                "commission_amount": entry.commission_amount,
+                "invoice_payment_date": entry.invoice_payment_date
+            }
+            for entry in entries
+        ]
+    })
+    payment.insert()
+
+    if run_doc.submit_payments:
+        payment.submit()
+
+    return payment.name
+
+def update_payout_progress(run):
+    """Recount the agents of a run, set its status and publish the progress"""
+    counts = {}
+    paid_amount = 0
+    for status, count, amount in frappe.db.sql("""
+        SELECT status, COUNT(*), SUM(amount)
+        FROM `tabAgent Payout Run Item`
+        WHERE parent = %s
+        AND parenttype = 'Agent Payout Run'
+        GROUP BY status
+    """, run):
+        counts[status] = count
+        if status == "Created":
+            paid_amount = flt(amount)
+
+    total = sum(counts.values())
+    pending = counts.get("Pending", 0)
+    failed = counts.get("Failed", 0)
+
+    if pending:
+        status = "In Progress"
+    elif not failed:
+        status = "Completed"
+    else:
+        status = "Failed" if failed == total else "Partially Failed"
+
+    frappe.db.set_value("Agent Payout Run", run, {
+        "status": status,
+        "processed_agents": total - pending,
+        "failed_agents": failed,
+        "paid_amount": paid_amount
+    }, update_modified=False)
+    frappe.db.commit()
+
+    frappe.publish_realtime("agent_payout_run_progress", {
+        "run": run,
+        "status": status,
+        "total": total,
+        "processed": total - pending,
+        "failed": failed
+    }, doctype="Agent Payout Run", docname=run)
@@ -4,7 +4,9 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import flt
+from frappe.utils import cint, flt
+
+DEFAULT_PAGE_LENGTH = 500
 
 
 class CommissionPaymentVoucher(Document):
@@ -51,11 +53,45 @@ class CommissionPaymentVoucher(Document):
 		for entry in self.commission_entries:
 			if not entry.commission_entry:
 				frappe.throw(_("Commission Entry is required for all entries"))
+		
+		# Validate paid amount
+		self.validate_paid_amounts(self.get_commission_entry_values())
+
+	def validate_paid_amounts(self, commission_entries):
+		"""Paid amounts, summed per entry, must not exceed the outstanding commission"""
+		for name, paid_amount in self.get_paid_amounts().items():
+			commission_entry = commission_entries.get(name)
+			if not commission_entry:
+				frappe.throw(_("Commission Entry {0} not found").format(name), frappe.DoesNotExistError)
 			
-			# Validate paid amount
-			commission_doc = frappe.get_doc("Sales Agent Commission Entry", entry.commission_entry)
-			if flt(entry.paid_amount) > flt(commission_doc.outstanding_amount):
-				frappe.throw(_("Paid amount cannot exceed outstanding amount for commission entry {0}").format(entry.commission_entry))
+			outstanding_amount = flt(commission_entry.total_commission_amount) - flt(commission_entry.commission_paid_amount)
+			if paid_amount > outstanding_amount:
+				frappe.throw(_("Paid amount cannot exceed outstanding amount for commission entry {0}").format(name))
+
+	def get_paid_amounts(self):
+		paid_amounts = {}
+		for entry in self.commission_entries:
+			paid_amounts[entry.commission_entry] = paid_amounts.get(entry.commission_entry, 0) + flt(entry.paid_amount)
+		
+		return paid_amounts
+
+	def get_commission_entry_values(self, for_update=False):
+		"""Fetch the payment fields of all referenced commission entries in one
+		query, locking them for the rest of the transaction with `for_update`"""
+		names = list({d.commission_entry for d in self.commission_entries if d.commission_entry})
+		if not names:
+			return {}
+		
+		entries = frappe.db.sql("""
+			SELECT name, total_commission_amount, commission_paid_amount, commission_due_amount,
+				commission_payment_status, commission_payment_voucher, commission_payment_date
+			FROM `tabSales Agent Commission Entry`
+			WHERE name IN %(names)s
+			ORDER BY name
+			{for_update}
+		""".format(for_update="FOR UPDATE" if for_update else ""), {"names": tuple(names)}, as_dict=1)
+		
+		return {d.name: d for d in entries}
 
 	def on_submit(self):
 		"""Update commission entries when voucher is submitted"""
@@ -67,57 +103,126 @@ class CommissionPaymentVoucher(Document):
 
 	def update_commission_entries(self):
 		"""Update commission entries with payment information"""
-		for entry in self.commission_entries:
-			commission_doc = frappe.get_doc("Sales Agent Commission Entry", entry.commission_entry)
+		commission_entries = self.get_commission_entry_values(for_update=True)
+		# Checked again under the lock, so concurrent vouchers cannot overpay an entry
+		self.validate_paid_amounts(commission_entries)
+		
+		updates = {}
+		for name, paid_amount in self.get_paid_amounts().items():
+			commission_entry = commission_entries[name]
 			
 			# Update paid amount
-			commission_doc.paid_amount = flt(commission_doc.paid_amount or 0) + flt(entry.paid_amount)
-			commission_doc.commission_payment_voucher = self.name
-			commission_doc.payment_date = self.payment_date
+			commission_entry.commission_paid_amount = flt(commission_entry.commission_paid_amount) + paid_amount
+			commission_entry.commission_payment_voucher = self.name
+			commission_entry.commission_payment_date = self.payment_date
 			
 			# Update payment status
-			if flt(commission_doc.paid_amount) >= flt(commission_doc.total_commission_amount):
-				commission_doc.payment_status = "Paid"
+			if flt(commission_entry.commission_paid_amount) >= flt(commission_entry.total_commission_amount):
+				commission_entry.commission_payment_status = "Paid"
 			else:
-				commission_doc.payment_status = "Partially Paid"
+				commission_entry.commission_payment_status = "Partially Paid"
 			
-			commission_doc.calculate_outstanding_amount()
-			commission_doc.save()
+			updates[name] = get_payment_values(commission_entry)
+		
+		write_commission_entries(updates)
 
 	def revert_commission_entries(self):
 		"""Revert commission entries when voucher is cancelled"""
-		for entry in self.commission_entries:
-			commission_doc = frappe.get_doc("Sales Agent Commission Entry", entry.commission_entry)
+		commission_entries = self.get_commission_entry_values(for_update=True)
+		
+		updates = {}
+		for name, paid_amount in self.get_paid_amounts().items():
+			commission_entry = commission_entries.get(name)
+			if not commission_entry:
+				continue
 			
 			# Revert paid amount
-			commission_doc.paid_amount = flt(commission_doc.paid_amount or 0) - flt(entry.paid_amount)
+			commission_entry.commission_paid_amount = flt(commission_entry.commission_paid_amount) - paid_amount
 			
 			# Clear payment voucher reference
-			if commission_doc.commission_payment_voucher == self.name:
-				commission_doc.commission_payment_voucher = None
-				commission_doc.payment_date = None
+			if commission_entry.commission_payment_voucher == self.name:
+				commission_entry.commission_payment_voucher = None
+				commission_entry.commission_payment_date = None
 			
 			# Update payment status
-			if flt(commission_doc.paid_amount) <= 0:
-				commission_doc.payment_status = "Pending"
+			if flt(commission_entry.commission_paid_amount) <= 0:
+				commission_entry.commission_payment_status = "Due" if flt(commission_entry.commission_due_amount) > 0 else "Not Due"
 			else:
-				commission_doc.payment_status = "Partially Paid"
+				commission_entry.commission_payment_status = "Partially Paid"
 			
-			commission_doc.calculate_outstanding_amount()
-			commission_doc.save()
+			updates[name] = get_payment_values(commission_entry)
+		
+		write_commission_entries(updates)
+
+
+def get_payment_values(commission_entry):
+	"""Payment fields of a commission entry to write back, with its outstanding commission"""
+	return {
+		"commission_paid_amount": commission_entry.commission_paid_amount,
+		"commission_outstanding_amount": flt(commission_entry.total_commission_amount)
+			- flt(commission_entry.commission_paid_amount),
+		"commission_payment_status": commission_entry.commission_payment_status,
+		"commission_payment_voucher": commission_entry.commission_payment_voucher,
+		"commission_payment_date": commission_entry.commission_payment_date
+	}
+
+def write_commission_entries(updates):
+	"""Write payment fields of many commission entries in batched UPDATEs"""
+	if updates:
+		frappe.db.bulk_update("Sales Agent Commission Entry", updates)
 
 @frappe.whitelist()
-def get_pending_commission_entries(agent, company):
-	"""Get pending commission entries for an agent"""
-	return frappe.get_all("Sales Agent Commission Entry",
-		filters={
+def get_pending_commission_entries(agent, company, last_invoice_date=None, last_name=None,
+	page_length=None, aggregate_only=False):
+	"""Get pending commission entries of a sales partner, ordered by invoice date and name.
+
+	Entries are paged when a `page_length` or a cursor is given: pass the
+	invoice date and name of the last entry of a page to get the next page.
+	Without either, all pending entries are returned. With `aggregate_only`,
+	only the count and totals of all pending entries are returned."""
+	conditions = [
+		"sales_agent.sales_partner = %(agent)s",
+		"entry.company = %(company)s",
+		"entry.commission_payment_status IN ('Due', 'Partially Paid')",
+		"entry.docstatus = 1"
+	]
+	values = {
 		"agent": agent,
 		"company": company,
-		"payment_status": ["in", ["Pending", "Partially Paid"]],
-		"docstatus": 1
-		},
-	fields=["name", "sales_invoice", "customer", "posting_date", "total_commission_amount", "paid_amount", "outstanding_amount"]
-	)
+		"last_invoice_date": last_invoice_date,
+		"last_name": last_name,
+		"page_length": cint(page_length) or DEFAULT_PAGE_LENGTH
+	}
+	paged = bool(cint(page_length) or last_name)
+
+	if cint(aggregate_only):
+		return frappe.db.sql("""
+			SELECT COUNT(*) AS count,
+				IFNULL(SUM(entry.total_commission_amount), 0) AS total_commission_amount,
+				IFNULL(SUM(entry.commission_paid_amount), 0) AS commission_paid_amount,
+				IFNULL(SUM(entry.commission_outstanding_amount), 0) AS commission_outstanding_amount
+			FROM `tabSales Agent Commission Entry` entry
+			INNER JOIN `tabSales Agent` sales_agent ON sales_agent.name = entry.sales_agent
+			WHERE {0}
+		""".format(" AND ".join(conditions)), values, as_dict=1)[0]
+
+	if last_name:
+		if last_invoice_date:
+			conditions.append("""(entry.invoice_date > %(last_invoice_date)s
+				OR (entry.invoice_date = %(last_invoice_date)s AND entry.name > %(last_name)s))""")
+		else:
+			# Entries without an invoice date sort first
+			conditions.append("(entry.invoice_date IS NOT NULL OR entry.name > %(last_name)s)")
+
+	return frappe.db.sql("""
+		SELECT entry.name, entry.sales_invoice, entry.customer, entry.invoice_date,
+			entry.total_commission_amount, entry.commission_paid_amount, entry.commission_outstanding_amount
+		FROM `tabSales Agent Commission Entry` entry
+		INNER JOIN `tabSales Agent` sales_agent ON sales_agent.name = entry.sales_agent
+		WHERE {0}
+		ORDER BY entry.invoice_date, entry.name
+		{1}
+	""".format(" AND ".join(conditions), "LIMIT %(page_length)s" if paged else ""), values, as_dict=1)
 
 @frappe.whitelist()
 def update_commission_entries(commission_payment_voucher, method=None):
@@ -1,11 +1,16 @@
 # Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
+from bisect import bisect_right
+from datetime import date
+
 import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils import flt, getdate, today, now_datetime
 
+from sales_agent_commission.commission_calculator import RateRule
+
 
 class SalesAgent(Document):
 	# begin: auto-generated types
@@ -214,22 +219,81 @@ class SalesAgent(Document):
 			frappe.throw(_("Cannot cancel sales agent with existing commission entries"))
 
 	def get_commission_rate_for_item_group(self, item_group, posting_date=None):
-		"""Get commission rate for specific item group"""
-		if not posting_date:
-			posting_date = today()
+		"""Get commission rate for specific item group as a compiled RateRule"""
+		return find_rate_rule(self.get_commission_rate_index(), item_group, getdate(posting_date or today()))
+
+	def get_commission_rate_index(self):
+		"""Get the effective dated rate index of this agent version"""
+		if getattr(self, "_commission_rate_index", None) is None:
+			if self.is_new():
+				self._commission_rate_index = build_commission_rate_index(self.item_group_commission_rates)
+			else:
+				modified = str(self.modified)
+				cached = frappe.cache().hget(RATE_INDEX_CACHE_KEY, self.name)
+				if cached and cached[0] == modified:
+					self._commission_rate_index = cached[1]
+				else:
+					self._commission_rate_index = build_commission_rate_index(self.item_group_commission_rates)
+					frappe.cache().hset(RATE_INDEX_CACHE_KEY, self.name, (modified, self._commission_rate_index))
 		
-		for rate in self.item_group_commission_rates:
-			if rate.item_group == item_group:
-				# Check effective dates
-				if rate.effective_from and getdate(rate.effective_from) > getdate(posting_date):
-					continue
-				
-				if rate.effective_to and getdate(rate.effective_to) < getdate(posting_date):
-					continue
-				
-				return rate
+		return self._commission_rate_index
+
+
+# Rate indexes per agent in the site cache, replaced whenever the agent is modified
+RATE_INDEX_CACHE_KEY = "sales_agent_commission_rate_index"
+
+def build_commission_rate_index(rates):
+	"""Group commission rates by item group, sorted by effective date.
+
+	Each item group maps to parallel lists of parsed effective_from dates, the
+	running maximum of effective_to, parsed effective_to dates, table positions
+	and compiled RateRules, so a posting date is resolved with a bisect."""
+	grouped = {}
+	for rate in rates:
+		start = getdate(rate.effective_from) if rate.effective_from else date.min
+		end = getdate(rate.effective_to) if rate.effective_to else date.max
+		rule = RateRule.from_row(rate, start, end)
+		grouped.setdefault(rate.item_group, []).append((start, end, rate.idx or 0, rule))
+	
+	index = {}
+	for item_group, rows in grouped.items():
+		rows.sort(key=lambda d: (d[0], d[2]))
+		
+		max_ends = []
+		max_end = date.min
+		for row in rows:
+			max_end = max(max_end, row[1])
+			max_ends.append(max_end)
 		
+		index[item_group] = (
+			[d[0] for d in rows],
+			max_ends,
+			[d[1] for d in rows],
+			[d[2] for d in rows],
+			[d[3] for d in rows]
+		)
+	
+	return index
+
+def find_rate_rule(index, item_group, posting_date):
+	"""Get the RateRule of an item group effective on a posting date from a rate index.
+	When effective date ranges overlap, the earliest row in the rate table wins."""
+	history = index.get(item_group)
+	if not history:
 		return None
+	
+	starts, max_ends, ends, positions, rates = history
+	
+	# Walk back from the latest rate starting on or before the posting date,
+	# stopping as soon as no earlier rate can still be effective
+	match = None
+	idx = bisect_right(starts, posting_date) - 1
+	while idx >= 0 and max_ends[idx] >= posting_date:
+		if ends[idx] >= posting_date and (match is None or positions[idx] < positions[match]):
+			match = idx
+		idx -= 1
+	
+	return rates[match] if match is not None else None
 
 @frappe.whitelist()
 def create_sales_agent_from_partner(sales_partner, method=None):
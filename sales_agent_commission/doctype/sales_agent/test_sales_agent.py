@@ -0,0 +1,76 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, flt, nowdate
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+
+from sales_agent_commission.simulation import simulate_sales_agent
+
+TEST_AGENT = "_Test Simulation Agent"
+
+
+class TestSalesAgent(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		make_test_sales_agent()
+
+	def test_simulation_finds_invoices_through_commission_entries(self):
+		invoice = create_sales_invoice(qty=2, rate=500)
+		make_commission_entry(invoice)
+
+		# Neither an invoice without an entry nor one with a draft entry is the agent's
+		create_sales_invoice(qty=1, rate=700)
+		make_commission_entry(create_sales_invoice(qty=1, rate=900), submit=False)
+
+		# One invoice per chunk, so the keyset pagination runs too
+		result = simulate_sales_agent(TEST_AGENT, [{
+			"item_group": "_Test Item Group",
+			"commission_percentage": 15,
+			"effective_from": "2000-01-01"
+		}], add_days(nowdate(), -1), add_days(nowdate(), 1), 1)
+
+		self.assertEqual(result["invoices"], 1)
+		self.assertEqual(result["lines"], 1)
+		self.assertEqual(flt(result["current_commission"], 2), 100)
+		self.assertEqual(flt(result["proposed_commission"], 2), 150)
+		self.assertEqual([d["item_group"] for d in result["item_groups"]], ["_Test Item Group"])
+
+
+def make_commission_entry(invoice, submit=True):
+	entry = frappe.get_doc({
+		"doctype": "Sales Agent Commission Entry",
+		"sales_agent": TEST_AGENT,
+		"sales_invoice": invoice.name,
+		"customer": invoice.customer,
+		"company": invoice.company
+	}).insert()
+
+	if submit:
+		entry.submit()
+
+	return entry
+
+
+def make_test_sales_agent():
+	if frappe.db.exists("Sales Agent", TEST_AGENT):
+		return
+
+	# Left in draft, submitting would create a Sales Partner for it
+	frappe.get_doc({
+		"doctype": "Sales Agent",
+		"agent_code": TEST_AGENT,
+		"agent_name": TEST_AGENT,
+		"status": "Active",
+		"joining_date": "2000-01-01",
+		"agent_type": "External",
+		"commission_calculation_method": "Percentage",
+		"enable_commission": 1,
+		"item_group_commission_rates": [{
+			"item_group": "_Test Item Group",
+			"commission_percentage": 10,
+			"effective_from": "2000-01-01"
+		}]
+	}).insert()
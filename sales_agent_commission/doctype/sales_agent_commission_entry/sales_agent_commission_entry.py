@@ -4,25 +4,44 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import flt, getdate, today, now_datetime, cstr
+from frappe.utils import add_to_date, flt, getdate, today, now_datetime, cstr
+
+from sales_agent_commission.commission_calculator import (
+	InvoiceLine,
+	calculate_commission,
+	calculate_line_commissions,
+	to_rate_rule,
+)
+from sales_agent_commission.utils import DocumentCache, get_outstanding_amounts
 
 
 class SalesAgentCommissionEntry(Document):
 	def validate(self):
 		"""Validate commission entry"""
+		self.reset_document_cache()
 		self.validate_sales_invoice()
 		self.validate_sales_agent()
 		self.calculate_commission()
 		self.update_payment_status()
 		self.set_audit_details()
 
+	def reset_document_cache(self):
+		"""Load documents afresh for this save"""
+		self.flags.document_cache = DocumentCache()
+
+	def get_cached_doc(self, doctype, name):
+		if not self.flags.document_cache:
+			self.flags.document_cache = DocumentCache()
+
+		return self.flags.document_cache.get_doc(doctype, name)
+
 	def validate_sales_invoice(self):
 		"""Validate sales invoice"""
 		if not self.sales_invoice:
 			frappe.throw(_("Sales Invoice is required"))
 		
 		# Check if sales invoice exists and is submitted
-		si_doc = frappe.get_doc("Sales Invoice", self.sales_invoice)
+		si_doc = self.get_cached_doc("Sales Invoice", self.sales_invoice)
 		if si_doc.docstatus != 1:
 			frappe.throw(_("Sales Invoice must be submitted"))
 
@@ -32,7 +51,7 @@ class SalesAgentCommissionEntry(Document):
 			frappe.throw(_("Sales Agent is required"))
 		
 		# Check if sales agent is active
-		agent_doc = frappe.get_doc("Sales Agent", self.sales_agent)
+		agent_doc = self.get_cached_doc("Sales Agent", self.sales_agent)
 		if agent_doc.status != "Active":
 			frappe.throw(_("Sales Agent must be active"))
 		
@@ -66,97 +85,62 @@ class SalesAgentCommissionEntry(Document):
 
 	def create_commission_items(self):
 		"""Create commission items from sales invoice"""
-		si_doc = frappe.get_doc("Sales Invoice", self.sales_invoice)
-		agent_doc = frappe.get_doc("Sales Agent", self.sales_agent)
+		si_doc = self.get_cached_doc("Sales Invoice", self.sales_invoice)
+		agent_doc = self.get_cached_doc("Sales Agent", self.sales_agent)
 		
 		self.commission_items = []
+		posting_date = getdate(si_doc.posting_date)
+		calculation_method = agent_doc.commission_calculation_method
 		
-		for item in si_doc.items:
-			# Get commission rate for item group
-			commission_rate = agent_doc.get_commission_rate_for_item_group(
-				item.item_group, si_doc.posting_date
-			)
-			
-			if commission_rate:
-				commission_amount = self.calculate_item_commission(
-					item, commission_rate, agent_doc.commission_calculation_method
-				)
-				
-				self.append("commission_items", {
-					"item_code": item.item_code,
-					"item_name": item.item_name,
-					"item_group": item.item_group,
-					"qty": item.qty,
-					"rate": item.rate,
-					"amount": item.amount,
-					"base_amount": item.base_amount,
-					"commission_rate": commission_rate.commission_percentage or 0,
-					"commission_amount": commission_amount,
-					"calculation_method": agent_doc.commission_calculation_method
-				})
+		rows = calculate_line_commissions(
+			[InvoiceLine.from_row(item) for item in si_doc.items],
+			lambda item_group: agent_doc.get_commission_rate_for_item_group(item_group, posting_date),
+			calculation_method
+		)
+		
+		for row in rows:
+			item = row.line
+			self.append("commission_items", {
+				"item_code": item.item_code,
+				"item_name": item.item_name,
+				"item_group": item.item_group,
+				"qty": item.qty,
+				"rate": item.rate,
+				"amount": item.amount,
+				"base_amount": item.base_amount,
+				"commission_rate": row.commission_rate,
+				"commission_amount": row.commission_amount,
+				"calculation_method": calculation_method
+			})
 
 	def calculate_item_commission(self, item, commission_rate, calculation_method):
 		"""Calculate commission for individual item"""
-		if calculation_method == "Percentage":
-			commission = flt(item.base_amount) * flt(commission_rate.commission_percentage) / 100
-		elif calculation_method == "Fixed Amount":
-			commission = flt(commission_rate.fixed_amount) * flt(item.qty)
-		elif calculation_method == "Tiered":
-			commission = self.calculate_tiered_commission(item, commission_rate)
-		else:
-			commission = 0
-		
-		# Apply min/max limits
-		if commission_rate.minimum_amount and commission < commission_rate.minimum_amount:
-			commission = commission_rate.minimum_amount
-		
-		if commission_rate.maximum_amount and commission > commission_rate.maximum_amount:
-			commission = commission_rate.maximum_amount
-		
-		return commission
+		return calculate_commission(
+			item.base_amount, item.qty, to_rate_rule(commission_rate), calculation_method
+		)
 
 	def calculate_tiered_commission(self, item, commission_rate):
 		"""Calculate tiered commission"""
-		amount = flt(item.base_amount)
-		commission = 0
-		
-		for tier in commission_rate.tiered_rates:
-			tier_from = flt(tier.from_amount)
-			tier_to = flt(tier.to_amount) if tier.to_amount else float('inf')
-			
-			if amount > tier_from:
-				tier_amount = min(amount, tier_to) - tier_from
-				commission += tier_amount * flt(tier.commission_percentage) / 100
-		
-		return commission
+		return to_rate_rule(commission_rate).tier_schedule.commission(flt(item.base_amount))
 
 	def update_payment_status(self):
 		"""Update payment status based on invoice payments"""
 		# Get invoice payment status
-		si_doc = frappe.get_doc("Sales Invoice", self.sales_invoice)
+		si_doc = self.get_cached_doc("Sales Invoice", self.sales_invoice)
 		
 		self.invoice_outstanding_amount = si_doc.outstanding_amount
-		
-		if si_doc.outstanding_amount <= 0:
-			self.invoice_payment_status = "Paid"
-		elif si_doc.outstanding_amount < si_doc.grand_total:
-			self.invoice_payment_status = "Partially Paid"
-		else:
-			self.invoice_payment_status = "Unpaid"
+		self.invoice_payment_status = get_invoice_payment_status(si_doc.grand_total, si_doc.outstanding_amount)
 		
 		# Update commission due amount based on payment
 		self.update_commission_due_amount()
 
 	def update_commission_due_amount(self):
 		"""Update commission due amount based on payment reconciliation"""
-		si_doc = frappe.get_doc("Sales Invoice", self.sales_invoice)
+		si_doc = self.get_cached_doc("Sales Invoice", self.sales_invoice)
 		
-		# Calculate paid percentage
-		paid_amount = flt(si_doc.grand_total) - flt(si_doc.outstanding_amount)
-		paid_percentage = (paid_amount / flt(si_doc.grand_total)) * 100 if si_doc.grand_total > 0 else 0
-		
-		# Commission due is based on paid percentage
-		self.commission_due_amount = (flt(self.total_commission_amount) * paid_percentage) / 100
+		self.commission_due_amount = get_commission_due_amount(
+			self.total_commission_amount, si_doc.grand_total, si_doc.outstanding_amount
+		)
 		
 		# Commission outstanding is total minus paid
 		self.commission_outstanding_amount = flt(self.total_commission_amount) - flt(self.commission_paid_amount)
@@ -166,25 +150,11 @@ class SalesAgentCommissionEntry(Document):
 
 	def update_commission_status(self):
 		"""Update commission status"""
-		agent_doc = frappe.get_doc("Sales Agent", self.sales_agent)
-		
-		if self.invoice_payment_status == "Unpaid":
-			self.commission_status = "Pending Invoice Payment"
-			self.commission_payment_status = "Not Due"
-		elif self.invoice_payment_status in ["Partially Paid", "Paid"]:
-			if agent_doc.commission_on_payment:
-				self.commission_status = "Due for Payment"
-				if self.commission_due_amount > 0:
-					self.commission_payment_status = "Due"
-			else:
-				self.commission_status = "Pending Invoice Payment"
-				self.commission_payment_status = "Not Due"
+		agent_doc = self.get_cached_doc("Sales Agent", self.sales_agent)
 		
-		# Update based on commission payments
-		if flt(self.commission_paid_amount) >= flt(self.commission_due_amount):
-			self.commission_payment_status = "Paid"
-		elif flt(self.commission_paid_amount) > 0:
-			self.commission_payment_status = "Partially Paid"
+		self.commission_status, self.commission_payment_status = get_commission_status(
+			self, agent_doc.commission_on_payment
+		)
 
 	def set_audit_details(self):
 		"""Set audit details"""
@@ -193,7 +163,7 @@ class SalesAgentCommissionEntry(Document):
 		User: {frappe.session.user}
 		Sales Invoice: {self.sales_invoice}
 		Sales Agent: {self.sales_agent}
-		Commission Method: {frappe.get_value('Sales Agent', self.sales_agent, 'commission_calculation_method')}
+		Commission Method: {self.get_cached_doc('Sales Agent', self.sales_agent).commission_calculation_method}
 		"""
 		
 		calculation_details = f"""
@@ -262,9 +232,7 @@ def update_commission_payment_status(doc, method=None):
 		return
 	
 	# Get sales invoices from payment entry
-	for reference in doc.references:
-		if reference.reference_doctype == "Sales Invoice":
-			update_commission_entries_for_invoice(reference.reference_name)
+	refresh_payment_status([d.reference_name for d in doc.references if d.reference_doctype == "Sales Invoice"])
 
 @frappe.whitelist()
 def revert_commission_payment_status(doc, method=None):
@@ -273,9 +241,7 @@ def revert_commission_payment_status(doc, method=None):
 		return
 	
 	# Get sales invoices from payment entry
-	for reference in doc.references:
-		if reference.reference_doctype == "Sales Invoice":
-			update_commission_entries_for_invoice(reference.reference_name)
+	refresh_payment_status([d.reference_name for d in doc.references if d.reference_doctype == "Sales Invoice"])
 
 @frappe.whitelist()
 def update_commission_due_status(doc, method=None):
@@ -284,9 +250,7 @@ def update_commission_due_status(doc, method=None):
 		return
 	
 	# Update commission entries for reconciled invoices
-	for entry in doc.allocation:
-		if entry.reference_type == "Sales Invoice":
-			update_commission_entries_for_invoice(entry.reference_name)
+	refresh_payment_status([d.reference_name for d in doc.allocation if d.reference_type == "Sales Invoice"])
 
 @frappe.whitelist()
 def revert_commission_due_status(doc, method=None):
@@ -295,38 +259,190 @@ def revert_commission_due_status(doc, method=None):
 		return
 	
 	# Update commission entries for reconciled invoices
-	for entry in doc.allocation:
-		if entry.reference_type == "Sales Invoice":
-			update_commission_entries_for_invoice(entry.reference_name)
+	refresh_payment_status([d.reference_name for d in doc.allocation if d.reference_type == "Sales Invoice"])
 
 def update_commission_entries_for_invoice(sales_invoice):
 	"""Update all commission entries for a sales invoice"""
-	commission_entries = frappe.get_all("Sales Agent Commission Entry",
-		filters={"sales_invoice": sales_invoice, "docstatus": 1},
-		fields=["name"]
+	refresh_payment_status([sales_invoice])
+
+# Payment status rules, shared by the document and the set based refresh
+
+PAYMENT_STATUS_FIELDS = (
+	"invoice_outstanding_amount",
+	"invoice_payment_status",
+	"commission_due_amount",
+	"commission_outstanding_amount",
+	"commission_status",
+	"commission_payment_status"
+)
+
+def get_invoice_payment_status(grand_total, outstanding_amount):
+	if flt(outstanding_amount) <= 0:
+		return "Paid"
+	elif flt(outstanding_amount) < flt(grand_total):
+		return "Partially Paid"
+	else:
+		return "Unpaid"
+
+def get_commission_due_amount(total_commission_amount, grand_total, outstanding_amount):
+	"""Commission due in proportion to the paid part of the invoice"""
+	paid_amount = flt(grand_total) - flt(outstanding_amount)
+	paid_percentage = (paid_amount / flt(grand_total)) * 100 if flt(grand_total) > 0 else 0
+	
+	return (flt(total_commission_amount) * paid_percentage) / 100
+
+def get_commission_status(entry, commission_on_payment):
+	"""Get (commission_status, commission_payment_status) of an entry.
+
+	`entry` needs invoice_payment_status, commission_due_amount,
+	commission_paid_amount and the current statuses, which are kept where no
+	rule applies."""
+	commission_status = entry.get("commission_status")
+	commission_payment_status = entry.get("commission_payment_status")
+	
+	if entry.get("invoice_payment_status") == "Unpaid":
+		commission_status = "Pending Invoice Payment"
+		commission_payment_status = "Not Due"
+	elif entry.get("invoice_payment_status") in ["Partially Paid", "Paid"]:
+		if commission_on_payment:
+			commission_status = "Due for Payment"
+			if flt(entry.get("commission_due_amount")) > 0:
+				commission_payment_status = "Due"
+		else:
+			commission_status = "Pending Invoice Payment"
+			commission_payment_status = "Not Due"
+	
+	# Update based on commission payments
+	if flt(entry.get("commission_paid_amount")) >= flt(entry.get("commission_due_amount")):
+		commission_payment_status = "Paid"
+	elif flt(entry.get("commission_paid_amount")) > 0:
+		commission_payment_status = "Partially Paid"
+	
+	return commission_status, commission_payment_status
+
+def get_payment_status_values(entry, grand_total, outstanding_amount, commission_on_payment):
+	"""Payment status fields of a commission entry for its invoice totals,
+	following the same rules as `update_payment_status`"""
+	values = frappe._dict({
+		"commission_status": entry.get("commission_status"),
+		"commission_payment_status": entry.get("commission_payment_status"),
+		"commission_paid_amount": entry.get("commission_paid_amount"),
+		"invoice_outstanding_amount": outstanding_amount,
+		"invoice_payment_status": get_invoice_payment_status(grand_total, outstanding_amount),
+		"commission_due_amount": get_commission_due_amount(
+			entry.get("total_commission_amount"), grand_total, outstanding_amount
+		),
+		"commission_outstanding_amount": flt(entry.get("total_commission_amount"))
+			- flt(entry.get("commission_paid_amount"))
+	})
+	values.commission_status, values.commission_payment_status = get_commission_status(values, commission_on_payment)
+	
+	return {field: values[field] for field in PAYMENT_STATUS_FIELDS}
+
+def refresh_payment_status(sales_invoices):
+	"""Refresh the payment status fields of the submitted commission entries
+	of many invoices.
+
+	The invoice total comes from the snapshot on the entry and outstanding
+	amounts from the Payment Ledger in one query, so the invoices are never
+	read. Only entries whose values changed are written, with batched
+	UPDATEs instead of a save per entry. Returns the number of updated
+	entries."""
+	sales_invoices = list(set(filter(None, sales_invoices)))
+	if not sales_invoices:
+		return 0
+	
+	entries = frappe.get_all("Sales Agent Commission Entry",
+		filters={"sales_invoice": ["in", sales_invoices], "docstatus": 1},
+		fields=["name", "sales_invoice", "sales_agent", "invoice_amount", "total_commission_amount",
+			"commission_paid_amount", *PAYMENT_STATUS_FIELDS]
 	)
+	if not entries:
+		return 0
 	
-	for entry in commission_entries:
-		commission_doc = frappe.get_doc("Sales Agent Commission Entry", entry.name)
-		commission_doc.update_payment_status()
-		commission_doc.save()
+	outstanding_amounts = get_outstanding_amounts({d.sales_invoice for d in entries})
+	commission_on_payment = dict(frappe.get_all("Sales Agent",
+		filters={"name": ["in", list({d.sales_agent for d in entries})]},
+		fields=["name", "commission_on_payment"],
+		as_list=1))
+	
+	updates = {}
+	for entry in entries:
+		outstanding_amount = outstanding_amounts.get(entry.sales_invoice)
+		if outstanding_amount is None:
+			continue
+		
+		values = get_payment_status_values(entry, entry.invoice_amount, outstanding_amount,
+			commission_on_payment.get(entry.sales_agent))
+		changed = {
+			field: value for field, value in values.items()
+			if (flt(value, 9) != flt(entry.get(field), 9) if isinstance(value, (int, float)) else value != entry.get(field))
+		}
+		if changed:
+			updates[entry.name] = changed
+	
+	if updates:
+		frappe.db.bulk_update("Sales Agent Commission Entry", updates)
+	
+	return len(updates)
+
+STATUS_WATERMARK_KEY = "sales_agent_commission_status_watermark"
+STATUS_BATCH_SIZE = 500
+# Payment Ledger Entries committed late by transactions open when a run
+# starts carry an earlier modified, so each run re-reads this far back
+STATUS_WATERMARK_MARGIN_MINUTES = 15
 
 @frappe.whitelist()
 def update_commission_status_daily():
-	"""Daily scheduler to update commission status"""
-	# Get all submitted commission entries
-	commission_entries = frappe.get_all("Sales Agent Commission Entry",
-		filters={"docstatus": 1},
-		fields=["name"]
-	)
+	"""Daily scheduler to update commission status.
+
+	Only entries of invoices changed since the last successful run are
+	refreshed, in batches committed one at a time."""
+	watermark = frappe.db.get_global(STATUS_WATERMARK_KEY)
+	# Taken before reading, so changes made during the run are picked up next time
+	started = add_to_date(now_datetime(), minutes=-STATUS_WATERMARK_MARGIN_MINUTES)
 	
-	for entry in commission_entries:
+	invoices = get_invoices_changed_since(watermark)
+	failed = False
+	for i in range(0, len(invoices), STATUS_BATCH_SIZE):
+		batch = invoices[i:i + STATUS_BATCH_SIZE]
 		try:
-			commission_doc = frappe.get_doc("Sales Agent Commission Entry", entry.name)
-			commission_doc.update_payment_status()
-			commission_doc.save()
-		except Exception as e:
-			frappe.log_error(f"Error updating commission entry {entry.name}: {str(e)}")
+			refresh_payment_status(batch)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title=f"Error updating commission entries of {len(batch)} invoices")
+			failed = True
+	
+	# Keep the old watermark after a failure so the batch is retried on the next run
+	if not failed:
+		frappe.db.set_global(STATUS_WATERMARK_KEY, str(started))
+		frappe.db.commit()
+
+def get_invoices_changed_since(watermark=None):
+	"""Get invoices with submitted commission entries whose outstanding amount
+	may have changed since the watermark, i.e. one of their Payment Ledger
+	Entries was modified. All of them without a watermark."""
+	if not watermark:
+		return frappe.get_all("Sales Agent Commission Entry",
+			filters={"docstatus": 1},
+			pluck="sales_invoice",
+			distinct=True,
+			order_by="sales_invoice"
+		)
+	
+	return [d[0] for d in frappe.db.sql("""
+		SELECT DISTINCT sace.sales_invoice
+		FROM `tabSales Agent Commission Entry` sace
+		INNER JOIN (
+			SELECT DISTINCT against_voucher_no AS sales_invoice
+			FROM `tabPayment Ledger Entry`
+			WHERE against_voucher_type = 'Sales Invoice'
+			AND modified >= %(watermark)s
+		) changed ON changed.sales_invoice = sace.sales_invoice
+		WHERE sace.docstatus = 1
+		ORDER BY sace.sales_invoice
+	""", {"watermark": watermark})]
 
 @frappe.whitelist()
 def send_commission_statements():
@@ -388,4 +504,8 @@ def send_agent_commission_statement(agent_name):
 		recipients=[agent_doc.email],
 		subject=subject,
 		content=content
-	)
\ No newline at end of file
+	)
+
+def on_doctype_update():
+	# Pending entries of a sales agent are paged by (invoice_date, name)
+	frappe.db.add_index("Sales Agent Commission Entry", ["sales_agent", "commission_payment_status", "invoice_date"])
@@ -126,6 +126,17 @@ doc_events = {
 		"on_submit": [
 			"sales_agent_commission.overrides.update_commission_entries_on_reconciliation"
 		]
+	},
+	"Territory": {
+		"on_update": [
+			"sales_agent_commission.agent_resolver.clear_assignment_map"
+		],
+		"on_trash": [
+			"sales_agent_commission.agent_resolver.clear_assignment_map"
+		],
+		"after_rename": [
+			"sales_agent_commission.agent_resolver.clear_assignment_map"
+		]
 	}
 }
 
@@ -133,6 +144,9 @@ doc_events = {
 # ---------------
 
 scheduler_events = {
+	"all": [
+		"sales_agent_commission.commission_queue.requeue_pending_invoices"
+	],
 	"daily": [
 		"sales_agent_commission.tasks.check_agreement_expiry",
 		"sales_agent_commission.tasks.update_commission_status_daily"
@@ -141,7 +155,8 @@ scheduler_events = {
 		"sales_agent_commission.tasks.send_commission_statements"
 	],
 	"monthly": [
-		"sales_agent_commission.tasks.generate_monthly_commission_report"
+		"sales_agent_commission.tasks.generate_monthly_commission_report",
+		"sales_agent_commission.agent_ledger.create_ledger_checkpoints"
 	]
 }
 
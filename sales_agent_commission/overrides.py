@@ -11,44 +11,68 @@ def create_agent_commission_entries(doc, method):
     """Create commission entries when Sales Invoice is submitted"""
     if doc.docstatus != 1:
         return
-        
+    
+    from sales_agent_commission.commission_queue import enqueue_commission_creation, is_background_creation_enabled
+    
+    # Leave the work to the background workers when enabled
+    if is_background_creation_enabled():
+        enqueue_commission_creation(doc.name)
+        return
+    
+    commission_entries = create_commissions_for_invoice(doc.name)
+    
+    if commission_entries:
+        frappe.msgprint(_("{0} commission entries created").format(len(commission_entries)))
+
+def create_commissions_for_invoice(sales_invoice, bulk=False):
+    """Create commission entries for an invoice and stamp its commission summary"""
     # Import the function from the agent commission entry module
     from sales_agent_commission.doctype.agent_commission_entry.agent_commission_entry import create_commission_from_invoice
     
     # Create commission entries
-    commission_entries = create_commission_from_invoice(doc.name)
+    commission_entries = create_commission_from_invoice(sales_invoice, bulk=bulk)
     
     if commission_entries:
-        # Update Sales Invoice with commission information
-        applicable_agents = frappe.db.sql("""
-            SELECT DISTINCT agent_name 
-            FROM `tabAgent Commission Entry`
-            WHERE sales_invoice = %s
-        """, doc.name, as_list=1)
-        
-        total_commission = frappe.db.sql("""
-            SELECT SUM(commission_amount)
-            FROM `tabAgent Commission Entry`
-            WHERE sales_invoice = %s AND docstatus = 1
-        """, doc.name)[0][0] or 0
-        
-        frappe.db.set_value("Sales Invoice", doc.name, {
-            "commission_entries_created": 1,
-            "applicable_agents": ", ".join([a[0] for a in applicable_agents]),
-            "total_commission_amount": total_commission
-        })
-        
-        frappe.msgprint(_("{0} commission entries created").format(len(commission_entries)))
+        update_invoice_commission_summary(sales_invoice)
+    
+    return commission_entries
+
+def update_invoice_commission_summary(sales_invoice):
+    """Update Sales Invoice with commission information"""
+    applicable_agents = frappe.db.sql("""
+        SELECT DISTINCT agent_name 
+        FROM `tabAgent Commission Entry`
+        WHERE sales_invoice = %s
+    """, sales_invoice, as_list=1)
+    
+    total_commission = frappe.db.sql("""
+        SELECT SUM(commission_amount)
+        FROM `tabAgent Commission Entry`
+        WHERE sales_invoice = %s AND docstatus = 1
+    """, sales_invoice)[0][0] or 0
+    
+    frappe.db.set_value("Sales Invoice", sales_invoice, {
+        "commission_entries_created": 1,
+        "applicable_agents": ", ".join([a[0] for a in applicable_agents]),
+        "total_commission_amount": total_commission
+    })
 
 def cancel_agent_commission_entries(doc, method):
     """Cancel commission entries when Sales Invoice is cancelled"""
     if doc.docstatus != 2:
         return
+    
+    from sales_agent_commission.agent_ledger import lock_agent_balances
+    from sales_agent_commission.commission_queue import dequeue_commission_creation
+    dequeue_commission_creation(doc.name)
         
     # Get all commission entries for this invoice
     commission_entries = frappe.get_all("Agent Commission Entry",
         filters={"sales_invoice": doc.name, "docstatus": 1},
-        fields=["name"])
+        fields=["name", "agent"])
+    
+    # Lock the balances of all agents before cancelling any entry
+    lock_agent_balances([d.agent for d in commission_entries])
     
     for entry in commission_entries:
         commission_doc = frappe.get_doc("Agent Commission Entry", entry.name)
@@ -86,12 +110,16 @@ def check_invoice_payment_reconciliation(doc, method):
 
 def update_commission_status_for_invoice(invoice):
     """Update commission status when invoice is paid"""
+    from sales_agent_commission.doctype.agent_commission_entry.agent_commission_entry import (
+        update_invoice_snapshot,
+        update_payment_status
+    )
+    
     # Check if invoice is fully paid
-    invoice_doc = frappe.get_doc("Sales Invoice", invoice)
+    outstanding_amount = update_invoice_snapshot(invoice)
     
-    if invoice_doc.outstanding_amount == 0:
+    if outstanding_amount is not None and flt(outstanding_amount) == 0:
         # Update commission entries to Due status
-        from sales_agent_commission.doctype.agent_commission_entry.agent_commission_entry import update_payment_status
         update_payment_status(invoice)
         
         # Notify agents
@@ -117,6 +145,8 @@ def revert_invoice_payment_reconciliation(doc, method):
     if doc.payment_type != "Receive":
         return
         
+    from sales_agent_commission.doctype.agent_commission_entry.agent_commission_entry import update_invoice_snapshot
+    
     for reference in doc.references:
         if reference.reference_doctype == "Sales Invoice":
             # Revert commission entries to Pending status
@@ -125,6 +155,7 @@ def revert_invoice_payment_reconciliation(doc, method):
                 SET is_invoice_paid = 0, status = 'Pending'
                 WHERE sales_invoice = %s AND docstatus = 1
             """, reference.reference_name)
+            update_invoice_snapshot(reference.reference_name)
 
 def update_commission_entries_on_reconciliation(doc, method):
     """Update commission entries when Payment Reconciliation is submitted"""
@@ -0,0 +1,13 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import frappe
+
+
+def execute():
+	"""Capture the invoice outstanding amount on existing Agent Commission Entries"""
+	frappe.db.sql("""
+		UPDATE `tabAgent Commission Entry` ace
+		INNER JOIN `tabSales Invoice` si ON si.name = ace.sales_invoice
+		SET ace.invoice_outstanding_amount = si.outstanding_amount
+	""")
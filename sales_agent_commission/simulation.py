@@ -0,0 +1,285 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""What-if commission simulation.
+
+Recalculates the commission of an agent's historical invoices under its
+current and a proposed rate table, entirely in memory with the same
+calculation core used when entries are created. Invoices are streamed in
+keyset paginated chunks and nothing is written.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import add_months, cint, flt, getdate, today
+
+from sales_agent_commission.agent_resolver import (
+	build_territory_index,
+	get_covering_territories,
+	get_territory_bounds,
+)
+from sales_agent_commission.backfill import get_invoice_lines
+from sales_agent_commission.commission_calculator import (
+	InvoiceLine,
+	calculate_commissions_batch,
+	calculate_group_commissions,
+)
+
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_MONTHS = 12
+
+
+@frappe.whitelist()
+def simulate_commission_rates(agent_type, proposed_rates, from_date=None, to_date=None,
+	calculation_method=None, chunk_size=DEFAULT_CHUNK_SIZE):
+	"""Compare current and proposed commission per agent and item group.
+
+	`agent_type` is "Agent Master" or "Sales Agent" and `proposed_rates` maps
+	each agent to its proposed rate rows, laid out like the agent's rate table
+	(a Sales Agent rate carries its tiers as `tiered_rates`). The period
+	defaults to the last 12 months."""
+	frappe.only_for(("System Manager", "Accounts Manager"))
+
+	simulate = SIMULATORS.get(agent_type)
+	if not simulate:
+		frappe.throw(_("Commission simulation is not supported for {0}").format(agent_type))
+
+	proposed_rates = frappe.parse_json(proposed_rates) or {}
+	to_date = getdate(to_date or today())
+	from_date = getdate(from_date or add_months(to_date, -DEFAULT_MONTHS))
+	chunk_size = cint(chunk_size) or DEFAULT_CHUNK_SIZE
+
+	agents = {}
+	for agent, rates in proposed_rates.items():
+		frappe.has_permission(agent_type, "read", agent, throw=True)
+		agents[agent] = simulate(agent, rates or [], from_date, to_date, chunk_size, calculation_method)
+
+	current = sum(d["current_commission"] for d in agents.values())
+	proposed = sum(d["proposed_commission"] for d in agents.values())
+
+	return {
+		"agent_type": agent_type,
+		"from_date": from_date,
+		"to_date": to_date,
+		"agents": agents,
+		"current_commission": current,
+		"proposed_commission": proposed,
+		"difference": proposed - current
+	}
+
+
+def simulate_agent_master(agent, rates, from_date, to_date, chunk_size, calculation_method=None):
+	"""Simulate proposed Agent Commission Rate rows of an Agent Master"""
+	from sales_agent_commission.doctype.agent_master.agent_master import (
+		build_agent_rate_index,
+		get_agent_rate_index,
+	)
+
+	agent_doc = frappe.get_doc("Agent Master", agent)
+	current_index = get_agent_rate_index(agent)
+
+	# Replaced in memory only, the document is never saved
+	agent_doc.set("commission_rates", rates)
+	proposed_index = build_agent_rate_index(agent_doc)
+
+	scope = get_territory_scope(agent_doc)
+	customers = tuple({d.customer for d in agent_doc.customer_assignments if d.customer})
+	territories = tuple(d for d in scope["territory_bounds"] if get_covering_territories(scope, d))
+
+	conditions = []
+	if customers:
+		conditions.append("si.customer IN %(customers)s")
+	if territories:
+		conditions.append("si.territory IN %(territories)s")
+
+	groups = {}
+	invoices = lines = 0
+	if not conditions:
+		return summarize(groups, invoices, lines)
+
+	for chunk in iter_invoice_chunks("({0})".format(" OR ".join(conditions)),
+		{"customers": customers, "territories": territories}, from_date, to_date, chunk_size):
+		invoice_lines = get_invoice_lines([d.name for d in chunk])
+
+		for invoice in chunk:
+			rows = invoice_lines.get(invoice.name)
+			if not rows:
+				continue
+
+			invoices += 1
+			lines += len(rows)
+
+			item_group_totals = {}
+			for item_group, amount in rows:
+				item_group_totals[item_group] = item_group_totals.get(item_group, 0) + flt(amount)
+
+			covering = get_covering_territories(scope, invoice.territory)
+			for item_group, amount in item_group_totals.items():
+				add_to_group(groups, item_group, amount=amount)
+			for row in calculate_group_commissions(item_group_totals, current_index, invoice.customer, covering):
+				add_to_group(groups, row.item_group, current=row.commission_amount)
+			for row in calculate_group_commissions(item_group_totals, proposed_index, invoice.customer, covering):
+				add_to_group(groups, row.item_group, proposed=row.commission_amount)
+
+	return summarize(groups, invoices, lines)
+
+
+def simulate_sales_agent(agent, rates, from_date, to_date, chunk_size, calculation_method=None):
+	"""Simulate proposed Sales Agent Commission Rate rows of a Sales Agent"""
+	from sales_agent_commission.doctype.sales_agent.sales_agent import (
+		build_commission_rate_index,
+		find_rate_rule,
+	)
+
+	agent_doc = frappe.get_doc("Sales Agent", agent)
+	current_index = agent_doc.get_commission_rate_index()
+	proposed_index = build_commission_rate_index([frappe._dict(row, idx=idx) for idx, row in enumerate(rates, 1)])
+	current_method = agent_doc.commission_calculation_method
+	proposed_method = calculation_method or current_method
+
+	groups = {}
+	invoices = lines = 0
+	# Sales Invoice has no agent of its own, so the agent's invoices are the
+	# ones it holds submitted commission entries on
+	for chunk in iter_invoice_chunks(None, {"sales_agent": agent}, from_date, to_date, chunk_size,
+		join="""INNER JOIN (
+			SELECT DISTINCT sales_invoice
+			FROM `tabSales Agent Commission Entry`
+			WHERE sales_agent = %(sales_agent)s
+			AND docstatus = 1
+		) sace ON sace.sales_invoice = si.name"""):
+		invoice_lines = get_sales_agent_lines([d.name for d in chunk])
+
+		current_lines, proposed_lines = [], []
+		for invoice in chunk:
+			rows = invoice_lines.get(invoice.name)
+			if not rows:
+				continue
+
+			invoices += 1
+			lines += len(rows)
+			posting_date = getdate(invoice.posting_date)
+
+			for line in rows:
+				add_to_group(groups, line.item_group, amount=line.base_amount)
+				current_lines.append((line, find_rate_rule(current_index, line.item_group, posting_date)))
+				proposed_lines.append((line, find_rate_rule(proposed_index, line.item_group, posting_date)))
+
+		# Lines of a whole chunk are calculated together, so tiered rates run
+		# vectorized per rate rule
+		for line, commission in calculate_commissions_batch(current_lines, current_method):
+			add_to_group(groups, line.item_group, current=commission)
+		for line, commission in calculate_commissions_batch(proposed_lines, proposed_method):
+			add_to_group(groups, line.item_group, proposed=commission)
+
+	return summarize(groups, invoices, lines)
+
+
+SIMULATORS = {
+	"Agent Master": simulate_agent_master,
+	"Sales Agent": simulate_sales_agent
+}
+
+
+def get_territory_scope(agent_doc):
+	"""Territory index of a single Agent Master, covering the whole tree.
+
+	Only the agent's own assignments matter for its rates, so the index does
+	not depend on the agent being active or present in the assignment map."""
+	scope = {
+		"territory": {d.territory: [agent_doc.name] for d in agent_doc.territories if d.territory},
+		"territory_bounds": get_territory_bounds()
+	}
+	build_territory_index(scope)
+
+	return scope
+
+
+def iter_invoice_chunks(condition, values, from_date, to_date, chunk_size, join=""):
+	"""Yield chunks of submitted invoices `si` matching a condition and an
+	optional join, keyset paginated on (posting_date, name)"""
+	if condition:
+		condition = "AND " + condition
+
+	last = None
+	while True:
+		keyset = ""
+		if last:
+			keyset = """AND (si.posting_date > %(last_posting_date)s
+				OR (si.posting_date = %(last_posting_date)s AND si.name > %(last_invoice)s))"""
+
+		chunk = frappe.db.sql("""
+			SELECT si.name, si.customer, si.territory, si.posting_date
+			FROM `tabSales Invoice` si
+			{join}
+			WHERE si.docstatus = 1
+			AND si.posting_date BETWEEN %(from_date)s AND %(to_date)s
+			{condition}
+			{keyset}
+			ORDER BY si.posting_date, si.name
+			LIMIT %(chunk_size)s
+		""".format(join=join, condition=condition or "", keyset=keyset), dict(values,
+			from_date=from_date,
+			to_date=to_date,
+			last_posting_date=last.posting_date if last else None,
+			last_invoice=last.name if last else None,
+			chunk_size=chunk_size
+		), as_dict=1)
+
+		if not chunk:
+			return
+
+		yield chunk
+		last = chunk[-1]
+
+
+def get_sales_agent_lines(invoices):
+	"""Get the invoice lines used by the Sales Agent pipeline with one query"""
+	items = frappe.db.sql("""
+		SELECT parent, item_group, qty, base_amount
+		FROM `tabSales Invoice Item`
+		WHERE parenttype = 'Sales Invoice'
+		AND parent IN %(invoices)s
+	""", {"invoices": tuple(invoices)})
+
+	lines = {}
+	for parent, item_group, qty, base_amount in items:
+		lines.setdefault(parent, []).append(InvoiceLine(None, item_group, qty=qty, base_amount=base_amount))
+
+	return lines
+
+
+def add_to_group(groups, item_group, amount=0, current=0, proposed=0):
+	totals = groups.get(item_group)
+	if totals is None:
+		totals = groups[item_group] = [0.0, 0.0, 0.0]
+
+	totals[0] += amount
+	totals[1] += current
+	totals[2] += proposed
+
+
+def summarize(groups, invoices, lines):
+	"""Per item group and total current vs proposed commission of an agent"""
+	item_groups = [
+		{
+			"item_group": item_group,
+			"amount": amount,
+			"current_commission": current,
+			"proposed_commission": proposed,
+			"difference": proposed - current
+		}
+		for item_group, (amount, current, proposed) in sorted(groups.items(), key=lambda d: d[0] or "")
+	]
+
+	current = sum(d["current_commission"] for d in item_groups)
+	proposed = sum(d["proposed_commission"] for d in item_groups)
+
+	return {
+		"invoices": invoices,
+		"lines": lines,
+		"item_groups": item_groups,
+		"current_commission": current,
+		"proposed_commission": proposed,
+		"difference": proposed - current
+	}
@@ -5,8 +5,12 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _
-from frappe.utils import today, add_days, getdate, get_datetime, now_datetime
+from frappe.utils import flt, today, add_days, getdate, get_datetime, now_datetime
 from datetime import datetime, timedelta
+from sales_agent_commission.agent_resolver import remove_agent_assignments
+from sales_agent_commission.utils import get_outstanding_amounts
+
+SNAPSHOT_BATCH_SIZE = 500
 
 def check_agreement_expiry():
     """Daily task to check and update agent agreement expiry status"""
@@ -30,6 +34,7 @@ def check_agreement_expiry():
         if days_to_expiry < 0:
             frappe.db.set_value("Agent Master", agent.name, "agreement_status", "Expired")
             frappe.db.set_value("Agent Master", agent.name, "status", "Inactive")
+            remove_agent_assignments(agent.name)
             
             # Send expiry notification
             send_agreement_expiry_notification(agent, "expired")
@@ -75,14 +80,15 @@ def send_agreement_expiry_notification(agent, status, days_to_expiry=None):
 
 def update_commission_status_daily():
     """Daily task to update commission status based on payment reconciliation"""
+    refresh_pending_invoice_snapshots()
+    
     # Get all pending commission entries where invoice is paid
     entries = frappe.db.sql("""
-        SELECT ce.name, ce.sales_invoice
-        FROM `tabAgent Commission Entry` ce
-        INNER JOIN `tabSales Invoice` si ON ce.sales_invoice = si.name
-        WHERE ce.status = 'Pending'
-        AND ce.docstatus = 1
-        AND si.outstanding_amount = 0
+        SELECT name, sales_invoice
+        FROM `tabAgent Commission Entry`
+        WHERE status = 'Pending'
+        AND docstatus = 1
+        AND invoice_outstanding_amount <= 0
     """, as_dict=1)
     
     for entry in entries:
@@ -97,6 +103,34 @@ def update_commission_status_daily():
         frappe.db.commit()
         print(f"Updated {len(entries)} commission entries to Due status")
 
+def refresh_pending_invoice_snapshots(batch_size=SNAPSHOT_BATCH_SIZE):
+    """Refresh the invoice snapshot of pending commission entries from the
+    Payment Ledger. The payment hooks only see Payment Entries and Payment
+    Reconciliations, so this catches invoices settled by Journal Entry or
+    credit note."""
+    snapshots = frappe.db.sql("""
+        SELECT DISTINCT sales_invoice, invoice_outstanding_amount
+        FROM `tabAgent Commission Entry`
+        WHERE status = 'Pending'
+        AND docstatus = 1
+    """)
+    
+    for i in range(0, len(snapshots), batch_size):
+        batch = snapshots[i:i + batch_size]
+        outstanding_amounts = get_outstanding_amounts([invoice for invoice, snapshot in batch])
+        
+        for invoice, snapshot in batch:
+            outstanding_amount = outstanding_amounts.get(invoice)
+            if outstanding_amount is None or flt(outstanding_amount, 2) == flt(snapshot, 2):
+                continue
+            
+            frappe.db.sql("""
+                UPDATE `tabAgent Commission Entry`
+                SET invoice_outstanding_amount = %s
+                WHERE sales_invoice = %s
+                AND docstatus = 1
+            """, (outstanding_amount, invoice))
+
 def send_commission_statements():
     """Weekly task to send commission statements to agents"""
     # Get all active agents
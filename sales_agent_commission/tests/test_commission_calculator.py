@@ -0,0 +1,169 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""Tests of the commission calculation core. They need no site."""
+
+import random
+import unittest
+from unittest.mock import patch
+
+from sales_agent_commission import commission_tiers
+from sales_agent_commission.commission_calculator import (
+	InvoiceLine,
+	RateRule,
+	calculate_commission,
+	calculate_commissions_batch,
+	calculate_line_commissions,
+	resolve_commission_rate,
+)
+from sales_agent_commission.commission_tiers import (
+	TierSchedule,
+	apply_commission_limits,
+	apply_commission_limits_batch,
+)
+
+
+def per_tier_commission(amount, tiers):
+	"""The per-tier loop TierSchedule replaced"""
+	commission = 0
+	for from_amount, to_amount, percentage in tiers:
+		tier_from = float(from_amount or 0)
+		tier_to = float(to_amount) if to_amount else float("inf")
+
+		if amount > tier_from:
+			commission += (min(amount, tier_to) - tier_from) * float(percentage or 0) / 100
+
+	return commission
+
+
+def clamp(commission, minimum_amount, maximum_amount):
+	"""The min/max clamping of the per-item calculation"""
+	if minimum_amount and commission < minimum_amount:
+		commission = minimum_amount
+
+	if maximum_amount and commission > maximum_amount:
+		commission = maximum_amount
+
+	return commission
+
+
+TIER_TABLES = [
+	[],
+	[(0, None, 5)],
+	[(0, 1000, 2), (1000, 5000, 4), (5000, None, 6)],
+	# Gaps between tiers
+	[(100, 500, 3), (1000, 2000, 5)],
+	# Overlapping tiers stack
+	[(0, 3000, 1), (1000, None, 2), (2000, 2500, 10)],
+	# Unsorted rows
+	[(5000, None, 1), (0, 5000, 3)],
+]
+
+
+def get_amounts(tiers):
+	amounts = [0, -50, 0.01, 999.99, 12345.67, 1e7]
+	for from_amount, to_amount, percentage in tiers:
+		for boundary in (from_amount, to_amount):
+			if boundary is not None:
+				amounts.extend((boundary - 0.01, boundary, boundary + 0.01))
+
+	rng = random.Random(7)
+	amounts.extend(rng.uniform(0, 10000) for i in range(200))
+	return amounts
+
+
+class TestTierSchedule(unittest.TestCase):
+	def test_single_amounts_match_per_tier_loop(self):
+		for tiers in TIER_TABLES:
+			schedule = TierSchedule(tiers)
+			for amount in get_amounts(tiers):
+				self.assertAlmostEqual(schedule.commission(amount), per_tier_commission(amount, tiers),
+					places=6, msg=f"{tiers} at {amount}")
+
+	def test_batch_matches_per_tier_loop(self):
+		for tiers in TIER_TABLES:
+			amounts = get_amounts(tiers)
+			expected = [per_tier_commission(amount, tiers) for amount in amounts]
+			for result in (TierSchedule(tiers).commissions(amounts), self.without_numpy(TierSchedule(tiers).commissions, amounts)):
+				for amount, commission, expected_commission in zip(amounts, result, expected):
+					self.assertAlmostEqual(float(commission), expected_commission, places=6,
+						msg=f"{tiers} at {amount}")
+
+	def test_batch_limits_match_clamping(self):
+		commissions = [0, 5, 10, 50, 100, 150, 1000]
+		for minimum_amount, maximum_amount in ((0, 0), (10, 0), (0, 100), (10, 100), (None, None)):
+			expected = [clamp(d, minimum_amount, maximum_amount) for d in commissions]
+			self.assertEqual([apply_commission_limits(d, minimum_amount, maximum_amount) for d in commissions],
+				expected)
+			for result in (apply_commission_limits_batch(commissions, minimum_amount, maximum_amount),
+				self.without_numpy(apply_commission_limits_batch, commissions, minimum_amount, maximum_amount)):
+				self.assertEqual([float(d) for d in result], expected)
+
+	def without_numpy(self, method, *args):
+		with patch.object(commission_tiers, "numpy", None):
+			return method(*args)
+
+
+class TestLineCommissions(unittest.TestCase):
+	def test_calculate_commission_methods(self):
+		rule = RateRule("Products", commission_percentage=10, fixed_amount=3, minimum_amount=5,
+			maximum_amount=400, tiers=[(0, 1000, 2), (1000, None, 4)])
+
+		self.assertAlmostEqual(calculate_commission(1000, 2, rule, "Percentage"), 100)
+		self.assertAlmostEqual(calculate_commission(10, 1, rule, "Percentage"), 5)
+		self.assertAlmostEqual(calculate_commission(10000, 1, rule, "Percentage"), 400)
+		self.assertAlmostEqual(calculate_commission(1000, 4, rule, "Fixed Amount"), 12)
+		self.assertAlmostEqual(calculate_commission(3000, 1, rule, "Tiered"),
+			clamp(per_tier_commission(3000, [(0, 1000, 2), (1000, None, 4)]), 5, 400))
+		self.assertEqual(calculate_commission(1000, 1, rule, "Unknown"), 5)
+
+	def test_batch_matches_line_by_line(self):
+		rules = {
+			"Products": RateRule("Products", commission_percentage=5, fixed_amount=2, minimum_amount=10,
+				tiers=[(0, 500, 1), (500, 2000, 3), (2000, None, 5)]),
+			"Services": RateRule("Services", commission_percentage=8, maximum_amount=150,
+				tiers=[(0, None, 7)])
+		}
+		rng = random.Random(11)
+		lines = [
+			InvoiceLine(None, rng.choice(["Products", "Services", "Unrated"]),
+				qty=rng.randint(1, 5), base_amount=round(rng.uniform(0, 5000), 2))
+			for i in range(300)
+		]
+
+		for method in ("Percentage", "Fixed Amount", "Tiered"):
+			expected = {
+				id(row.line): row.commission_amount
+				for row in calculate_line_commissions(lines, rules.get, method)
+			}
+			result = calculate_commissions_batch([(line, rules.get(line.item_group)) for line in lines], method)
+
+			self.assertEqual(len(result), len(expected))
+			for line, commission in result:
+				self.assertAlmostEqual(commission, expected[id(line)], places=6)
+
+
+class TestResolveCommissionRate(unittest.TestCase):
+	rate_index = {
+		("Products", "All", None): 2,
+		("Products", "Territory", "North"): 3,
+		("Products", "Territory", "India"): 4,
+		("Products", "Customer", "Acme"): 5,
+	}
+
+	def test_customer_rate_wins(self):
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Products", "Acme", ["North", "India"]), 5)
+
+	def test_nearest_territory_wins(self):
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Products", "Other", ["North", "India"]), 3)
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Products", None, ["Delhi", "India"]), 4)
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Products", None, "North"), 3)
+
+	def test_default_rate(self):
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Products", "Other", ["Delhi"]), 2)
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Products"), 2)
+		self.assertEqual(resolve_commission_rate(self.rate_index, "Services", "Acme", ["North"]), 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
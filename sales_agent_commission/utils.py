@@ -0,0 +1,40 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import flt
+
+
+class DocumentCache:
+	"""Documents loaded at most once within a single save"""
+
+	def __init__(self):
+		self.docs = {}
+
+	def get_doc(self, doctype, name):
+		key = (doctype, name)
+		doc = self.docs.get(key)
+		if doc is None:
+			doc = self.docs[key] = frappe.get_doc(doctype, name)
+
+		return doc
+
+
+def get_outstanding_amounts(sales_invoices):
+	"""Get the outstanding amount of Sales Invoices from the Payment Ledger,
+	without reading the invoices. Invoices without ledger entries are left out."""
+	sales_invoices = tuple(set(filter(None, sales_invoices)))
+	if not sales_invoices:
+		return {}
+
+	return {
+		invoice: flt(amount)
+		for invoice, amount in frappe.db.sql("""
+			SELECT against_voucher_no, SUM(amount_in_account_currency)
+			FROM `tabPayment Ledger Entry`
+			WHERE against_voucher_type = 'Sales Invoice'
+			AND against_voucher_no IN %(invoices)s
+			AND delinked = 0
+			GROUP BY against_voucher_no
+		""", {"invoices": sales_invoices})
+	}